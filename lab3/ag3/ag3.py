@@ -27,6 +27,7 @@ with tempfile.TemporaryDirectory() as tmpdir:
     system("cp policy.py {}".format(tmpdir))
     system("cp codec.py {}".format(tmpdir))
     system("cp dummy_server.py {}".format(tmpdir))
+    system("cp photo_cache.py {}".format(tmpdir))
 
     # # special autograder files
     system("cp ag3/ag3_imp_client.py {}/imp_client.py".format(tmpdir))
@@ -10,12 +10,15 @@ from markupsafe import escape
 
 from dummy_server import DummyServer
 from client import Client
+import crypto
 import wordlist
 
 app = Flask(__name__)
 
 client = None
 remote = DummyServer()
+# logins re-derive keys from the same few secrets
+crypto.enable_derived_key_cache()
 
 user_secrets = {}
 
@@ -49,7 +52,7 @@ def login():
     else:
         secret = user_secrets[username]
 
-    attempt = Client(username, remote, secret)
+    attempt = Client(username, remote, secret, lazy_photos=True)
     try:
         attempt.login()
         client = attempt
@@ -81,7 +84,7 @@ def register():
         abort(400)
 
     username = request.form["username"]
-    attempt = Client(username, remote)
+    attempt = Client(username, remote, lazy_photos=True)
     try:
         attempt.register()
         client = attempt
@@ -0,0 +1,638 @@
+#!/usr/bin/env python3
+
+"""
+bench holds performance benchmarks for the lab code.
+
+Run every benchmark with `./bench.py`, or only those whose names
+start with one of the given prefixes, e.g. `./bench.py codec`.  With
+`--json` the results are printed as one JSON document instead, for
+tracking regressions, e.g. `./bench.py --json crypto_primitives`.
+`--profile` runs the benchmarks under cProfile and prints the hottest
+functions to stderr.
+"""
+
+import copy
+import cProfile
+import json
+import os
+import pstats
+import sys
+import time
+
+import nacl.signing
+
+import api
+import client
+import codec
+import crypto
+import dummy_server
+
+benchmarks = []
+
+def bench_this(f):
+    benchmarks.append(f)
+    return f
+
+def best_time(f, repeat=3):
+    """Return the best wall-clock time, in seconds, over repeat calls to f."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def latencies(f, n):
+    """Return the sorted wall-clock times, in seconds, of n calls to f."""
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times
+
+def percentile(times, p):
+    """Return the p-th percentile of sorted times (nearest rank)."""
+    return times[min(len(times) - 1, int(p / 100 * len(times)))]
+
+# results collected by report() when printing JSON; None otherwise
+json_results = None
+
+def report(name, **fields):
+    if json_results is not None:
+        json_results.append(dict(name=name, **fields))
+        return
+    print("{:<32} {}".format(name, "  ".join(
+        "{}={}".format(k, "{:.6g}".format(v) if type(v) is float else v)
+        for k, v in fields.items())))
+
+### codec
+
+def _legacy_add_int(bytes_data, int_data):
+    """Append an int the way Encoding did before it was buffered."""
+    return bytes_data + codec.INT_SEPARATOR + int_data.to_bytes(8, 'little')
+
+@bench_this
+def codec_builder_scaling():
+    """Encoding.add_int should cost the same per item at every size."""
+    for n in [1000, 10000, 100000, 1000000]:
+        def build():
+            enc = codec.Encoding()
+            for i in range(n):
+                enc.add_int(i)
+            return enc.bytes_data
+        t = best_time(build, 1 if n >= 1000000 else 3)
+        report("codec_builder_scaling", items=n, seconds=t, ns_per_item=t / n * 1e9)
+    for n in [1000, 10000, 50000]:
+        def build_legacy():
+            bytes_data = b""
+            for i in range(n):
+                bytes_data = _legacy_add_int(bytes_data, i)
+            return bytes_data
+        t = best_time(build_legacy, 1)
+        report("codec_legacy_scaling", items=n, seconds=t, ns_per_item=t / n * 1e9)
+
+def _per_byte_pack(int_data):
+    """Pack an int the way add_int did before the struct fast path."""
+    return bytes([(int_data >> (8 * i)) & 0xFF for i in range(8)])
+
+def _per_byte_unpack(data):
+    return sum(data[i] << (8 * i) for i in range(8))
+
+@bench_this
+def codec_int_paths():
+    """Compare per-byte, struct and bulk struct int encoding."""
+    n = 100000
+    ints = list(range(n))
+    packed = [_per_byte_pack(i) for i in ints]
+    t = best_time(lambda: [_per_byte_pack(i) for i in ints])
+    report("codec_int_paths", path="per_byte_encode", ns_per_int=t / n * 1e9)
+    t = best_time(lambda: [_per_byte_unpack(d) for d in packed])
+    report("codec_int_paths", path="per_byte_decode", ns_per_int=t / n * 1e9)
+    def encode_each():
+        enc = codec.Encoding()
+        for i in ints:
+            enc.add_int(i)
+        return enc.bytes_data
+    t = best_time(encode_each)
+    report("codec_int_paths", path="add_int", ns_per_int=t / n * 1e9)
+    def encode_bulk():
+        enc = codec.Encoding()
+        enc.add_ints(ints)
+        return enc.bytes_data
+    t = best_time(encode_bulk)
+    report("codec_int_paths", path="add_ints", ns_per_int=t / n * 1e9)
+    data = encode_bulk()
+    t = best_time(lambda: list(codec.Encoding(data).items()))
+    report("codec_int_paths", path="items", ns_per_int=t / n * 1e9)
+    t = best_time(lambda: codec.Decoder(data).next_ints(n))
+    report("codec_int_paths", path="next_ints", ns_per_int=t / n * 1e9)
+
+def _throughput_inputs(size):
+    """Inputs of each kind with about size items (or size bytes for bins)."""
+    return {
+        "ints": list(range(size)),
+        "bins": [bytes(size)] * 16,
+        "dicts": [{"key{}".format(i): i for i in range(size // 16)}] * 16,
+        "strings": ["s" * 32] * size,
+        "nested_lists": [[i, [str(i), [bytes(8)]]] for i in range(size // 3)],
+    }
+
+@bench_this
+def codec_throughput():
+    """Encode and decode throughput for each kind of item."""
+    for size in [100, 10000, 100000]:
+        for (kind, obj) in _throughput_inputs(size).items():
+            def encode():
+                enc = codec.Encoding()
+                enc.add_obj(obj)
+                return enc.bytes_data
+            data = encode()
+            items = len(list(codec.Encoding(data).items()))
+            t_enc = best_time(encode)
+            t_dec = best_time(lambda: list(codec.Encoding(data).items()))
+            report("codec_throughput", kind=kind, size=size, bytes=len(data),
+                   encode_mb_s=len(data) / t_enc / 1e6, encode_items_s=items / t_enc,
+                   decode_mb_s=len(data) / t_dec / 1e6, decode_items_s=items / t_dec)
+
+@bench_this
+def codec_decode_scaling():
+    """Decoding should cost the same per byte at every size."""
+    photo = bytes(64 * 1024)
+    for n in [10, 100, 1000]:
+        enc = codec.Encoding()
+        for i in range(n):
+            enc.add_int(i)
+            enc.add_bin(photo)
+        size = len(enc.bytes_data)
+        for zero_copy in [False, True]:
+            t = best_time(lambda: list(enc.items_with_offsets(zero_copy)))
+            report("codec_decode_scaling", photos=n, zero_copy=zero_copy,
+                   seconds=t, mb_per_s=size / t / 1e6)
+    # small encodings such as log entries and profiles are the common
+    # case, so their per-item overhead must not grow either
+    log_entry = codec.Encoding()
+    log_entry.add_ints([1, 2])
+    profile = codec.Encoding()
+    profile.add_bin(bytes(32))
+    profile.add_string("user")
+    reps = 100000
+    for (kind, enc) in [("log_entry", log_entry), ("bin_str", profile)]:
+        enc.bytes_data
+        def decode():
+            for _ in range(reps):
+                enc.decode()
+        t = best_time(decode)
+        report("codec_decode_scaling", small=kind, us_per_decode=t / reps * 1e6)
+
+@bench_this
+def codec_sorted_dict_lookup():
+    """Fetch one field of a large dict by lookup and by full decode."""
+    for n in [100, 10000]:
+        d = {"field{}".format(i): bytes(64) for i in range(n)}
+        enc = codec.Encoding()
+        enc.add_sorted_dict(d)
+        data = enc.bytes_data
+        t = best_time(lambda: codec.Decoder(data).lookup("field7"))
+        report("codec_sorted_dict_lookup", pairs=n, path="lookup", seconds=t)
+        t = best_time(lambda: codec.Decoder(data).next_item()["field7"])
+        report("codec_sorted_dict_lookup", pairs=n, path="decode", seconds=t)
+
+@bench_this
+def codec_incremental_decode():
+    """Feed a photo-bearing encoding to IncrementalDecoder in chunks."""
+    enc = codec.Encoding()
+    for i in range(100):
+        enc.add_int(i)
+        enc.add_bin(bytes(256 * 1024))
+    data = enc.bytes_data
+    for chunk_size in [4096, 64 * 1024, 1024 * 1024]:
+        def decode():
+            decoder = codec.IncrementalDecoder()
+            for i in range(0, len(data), chunk_size):
+                decoder.feed(data[i:i + chunk_size])
+            decoder.close()
+        t = best_time(decode)
+        report("codec_incremental_decode", chunk_size=chunk_size,
+               seconds=t, mb_per_s=len(data) / t / 1e6)
+    # a single large dict streamed in small chunks should cost the same
+    # per byte at every size
+    for n in [1000, 2000, 4000, 16000]:
+        enc = codec.Encoding()
+        enc.add_dict({"key%d" % i: "value%d" % i for i in range(n)})
+        data = enc.bytes_data
+        def decode():
+            decoder = codec.IncrementalDecoder()
+            for i in range(0, len(data), 256):
+                decoder.feed(data[i:i + 256])
+            decoder.close()
+        t = best_time(decode)
+        report("codec_incremental_decode", dict_pairs=n, chunk_size=256,
+               dict_kb=len(data) / 1e3, seconds=t, mb_per_s=len(data) / t / 1e6)
+
+### client
+
+@bench_this
+def client_log_entries():
+    """Decode a 100k-entry sync response per entry and in one batch."""
+    n = 100000
+    entries = [client.encode_log_entry(codec.Encoding(),
+                                       client.LogEntry(api.OperationCode.PUT_PHOTO, i))
+               for i in range(n)]
+    t = best_time(lambda: [client.decode_log_entry(e.items()) for e in entries])
+    report("client_log_entries", path="per_entry", entries=n, seconds=t)
+    t = best_time(lambda: client.decode_log_entries(client.join_log_entries(entries)))
+    report("client_log_entries", path="batch", entries=n, seconds=t)
+
+@bench_this
+def client_public_profile_encode():
+    """Encode the same public profile repeatedly, memoized and not."""
+    infos = {"field{}".format(i): bytes(32) for i in range(50)}
+    profile = api.PublicProfile("bob", infos)
+    content = profile._content()
+    n = 10000
+    t = best_time(lambda: [profile.encode() for _ in range(n)])
+    report("client_public_profile_encode", path="memoized", per_s=n / t)
+    uncached = api._encode_public_profile.__wrapped__
+    t = best_time(lambda: [uncached(content) for _ in range(n)])
+    report("client_public_profile_encode", path="uncached", per_s=n / t)
+
+@bench_this
+def codec_compact_history():
+    """Compare fixed-width and compact encodings of a stored history."""
+    server = dummy_server.DummyServer()
+    alice = client.Client("alice", server)
+    alice.register()
+    for i in range(2000):
+        alice.put_photo(b"photo")
+    history = [codec.Encoding(entry) for entry in server._storage.user_history("alice", 0)]
+    entries = [list(entry.items()) for entry in history]
+    for compact in [False, True]:
+        def encode():
+            encoded = []
+            for items in entries:
+                enc = codec.Encoding(compact=compact)
+                enc.add_ints(items)
+                encoded.append(enc.bytes_data)
+            return encoded
+        encoded = encode()
+        size = sum(len(data) for data in encoded)
+        t_enc = best_time(encode)
+        t_dec = best_time(lambda: [list(codec.Encoding(data).items()) for data in encoded])
+        report("codec_compact_history", compact=compact, entries=len(entries),
+               bytes=size, encode_s=t_enc, decode_s=t_dec)
+
+class _CountingServer:
+    """Forward to a DummyServer, counting requests and photo bytes."""
+    def __init__(self, server):
+        self._server = server
+        self.requests = 0
+        self.photo_bytes = 0
+
+    def __getattr__(self, name):
+        method = getattr(self._server, name)
+        def counted(request):
+            self.requests += 1
+            resp = method(request)
+            for blob in getattr(resp, "photo_blobs", None) or [getattr(resp, "photo_blob", None)]:
+                if blob is not None:
+                    self.photo_bytes += len(blob)
+            return resp
+        return counted
+
+@bench_this
+def client_sync_batched_fetch():
+    """Catching up on 10k new photos, by photo batch size."""
+    server = dummy_server.DummyServer()
+    alice = client.Client("alice", server)
+    alice.register()
+    for i in range(10000):
+        alice.put_photo(i.to_bytes(8, 'little') * 128)
+    secret = alice.user_secret
+    for batch_size in [1, 16, 256]:
+        counting = _CountingServer(server)
+        def sync():
+            device = client.Client("alice", counting, secret)
+            device.photo_batch_size = batch_size
+            device.login()
+            device.list_photos()
+        t = best_time(sync, 1)
+        report("client_sync_batched_fetch", batch_size=batch_size, seconds=t,
+               requests=counting.requests, photo_mb=counting.photo_bytes / 1e6)
+
+@bench_this
+def client_lazy_photos():
+    """Listing a 20k-photo library on a new device, eager against lazy."""
+    server = dummy_server.DummyServer()
+    alice = client.Client("alice", server)
+    alice.register()
+    for i in range(20000):
+        alice.put_photo(i.to_bytes(8, 'little') * 128)
+    secret = alice.user_secret
+    for lazy_photos in [False, True]:
+        counting = _CountingServer(server)
+        def list_photos():
+            device = client.Client("alice", counting, secret, lazy_photos=lazy_photos)
+            device.login()
+            device.list_photos()
+        t = best_time(list_photos, 1)
+        report("client_lazy_photos", lazy_photos=lazy_photos, seconds=t,
+               photo_mb=counting.photo_bytes / 1e6)
+
+@bench_this
+def client_photo_cache():
+    """Syncing 64 MB of photos into a 4 MB photo cache, then reading
+    them back in order twice."""
+    server = dummy_server.DummyServer()
+    alice = client.Client("alice", server)
+    alice.register()
+    n = 1024
+    for i in range(n):
+        alice.put_photo(os.urandom(1 << 16))
+    class SmallCacheClient(client.Client):
+        photo_cache_bytes = 4 << 20
+    device = SmallCacheClient("alice", server, alice.user_secret)
+    start = time.perf_counter()
+    device.login()
+    device.list_photos()
+    report("client_photo_cache", phase="sync", seconds=time.perf_counter() - start,
+           **device.photo_cache_stats())
+    start = time.perf_counter()
+    for _ in range(2):
+        for photo_id in range(n):
+            device.get_photo(photo_id)
+    report("client_photo_cache", phase="read", seconds=time.perf_counter() - start,
+           **device.photo_cache_stats())
+
+### api
+
+@bench_this
+def api_round_trips():
+    """Round-trip requests through the wire format and through deepcopy."""
+    profile = api.PublicProfile("bob", {"bio": "photos", "key": bytes(32)})
+    profile.add_metadata(bytes(64))
+    album = api.PhotoAlbum("album", [bytes(1024)] * 16, "alice", {"bob": profile})
+    # distinct entries, as in a real history; deepcopy's memo would copy
+    # a repeated entry only once
+    log_entries = [client.encode_log_entry(codec.Encoding(), client.LogEntry(api.OperationCode.PUT_PHOTO, i))
+                   for i in range(100)]
+    requests = [
+        api.GetPhotoRequest("alice", "token", 1),
+        api.PutPhotoRequest("alice", "token", bytes(1024), 1, log_entries[0]),
+        api.SynchronizeResponse(None, log_entries),
+        api.UploadAlbumRequest("alice", "token", album),
+    ]
+    n = 1000
+    for req in requests:
+        cls = type(req)
+        t = best_time(lambda: [api.from_wire(cls, api.to_wire(req)) for _ in range(n)])
+        report("api_round_trips", request=cls.__name__, path="wire", per_s=n / t)
+        t = best_time(lambda: [copy.deepcopy(req) for _ in range(n)])
+        report("api_round_trips", request=cls.__name__, path="deepcopy", per_s=n / t)
+
+### crypto
+
+@bench_this
+def crypto_history_verify():
+    """Verify a history after 10 new entries, from scratch and incrementally."""
+    for n in [1000, 100000]:
+        history = [codec.encode_one_int(i) for i in range(n)]
+        new = [codec.encode_one_int(i) for i in range(10)]
+        expect = crypto.list_data_hash(history + new)
+        t = best_time(lambda: crypto.verify_list_data_hash(history + new, expect))
+        report("crypto_history_verify", history=n, path="full", seconds=t)
+        acc = crypto.ListDataHashAccumulator()
+        acc.add(history)
+        t = best_time(lambda: acc.verify(new, expect))
+        report("crypto_history_verify", history=n, path="accumulator", seconds=t)
+
+@bench_this
+def crypto_hash_chain_retention():
+    """Memory and random-access cost of each hash chain retention policy."""
+    n = 200000
+    hlist = crypto.to_hlist([codec.encode_one_int(i) for i in range(n)])
+    for keep_every in [crypto.KEEP_ALL_NODES, 1000, crypto.KEEP_TIP_ONLY]:
+        hchain = crypto._HashChain(hlist, keep_every=keep_every)
+        t = best_time(lambda: hchain.node(n // 2 + 7, hlist))
+        report("crypto_hash_chain_retention", keep_every=keep_every,
+               nodes=len(hchain.nodes), node_bytes=32 * len(hchain.nodes), node_lookup_s=t)
+
+@bench_this
+def crypto_merkle_proofs():
+    """Merkle proof sizes and costs against rehashing the whole chain."""
+    for n in [1000, 100000]:
+        hlist = crypto.to_hlist([codec.encode_one_int(i) for i in range(n)])
+        tree = crypto.MerkleTree(hlist)
+        root = tree.root()
+        old_root = tree.root(n - 10)
+        index = n // 3
+        proof = tree.inclusion_proof(index)
+        t_inc = best_time(lambda: crypto.verify_inclusion(hlist[index], index, n, proof, root))
+        consistency = tree.consistency_proof(n - 10)
+        t_con = best_time(lambda: crypto.verify_consistency(n - 10, old_root, n, root, consistency))
+        t_chain = best_time(lambda: crypto._hash_list(hlist))
+        report("crypto_merkle_proofs", leaves=n, inclusion_hashes=len(proof),
+               inclusion_verify_s=t_inc, consistency_hashes=len(consistency),
+               consistency_verify_s=t_con, chain_rehash_s=t_chain)
+
+@bench_this
+def crypto_parallel_to_hlist():
+    """Serial against thread-pool leaf hashing of photo-sized payloads."""
+    for (count, size) in [(1000, 4 * 1024), (64, 2 * 1024 * 1024)]:
+        data = [codec.encode_one_bin(bytes([i % 256]) * size) for i in range(count)]
+        total = sum(len(d.bytes_data) for d in data)
+        for parallel in [False, True]:
+            t = best_time(lambda: crypto.to_hlist(data, parallel))
+            report("crypto_parallel_to_hlist", leaves=count, leaf_bytes=size,
+                   parallel=parallel, workers=crypto._HASH_WORKERS, mb_per_s=total / t / 1e6)
+
+@bench_this
+def crypto_box_cache():
+    """Repeated public-key encryption to the same friend, with and without the Box cache."""
+    friend_pk = bytes(crypto.PublicKeyEncryptionAndAuthentication().get_public_key())
+    data = codec.encode_one_bin(bytes(1024))
+    n = 2000
+    for box_cache_size in [0, 128]:
+        sender = crypto.PublicKeyEncryptionAndAuthentication(box_cache_size=box_cache_size)
+        t = best_time(lambda: [sender.encrypt_and_auth(data, friend_pk) for _ in range(n)])
+        report("crypto_box_cache", box_cache_size=box_cache_size, encryptions_per_s=n / t)
+
+@bench_this
+def crypto_verify_batch():
+    """Verify 10k signatures from 10 users in a loop and as a batch."""
+    signers = [crypto.PublicKeySignature() for _ in range(10)]
+    items = []
+    for i in range(10000):
+        signer = signers[i % len(signers)]
+        data = codec.encode_one_int(i)
+        items.append((signer.get_public_key(), data, signer.sign(data)))
+    def verify_loop():
+        return [crypto.verify_sign(pk, data, signature) for (pk, data, signature) in items]
+    n = len(items)
+    t = best_time(lambda: [nacl.signing.VerifyKey(pk).verify(data.bytes_data, signature)
+                           for (pk, data, signature) in items], 1)
+    report("crypto_verify_batch", path="verify_key_per_call", per_s=n / t)
+    t = best_time(verify_loop, 1)
+    report("crypto_verify_batch", path="verify_sign_loop", per_s=n / t)
+    t = best_time(lambda: crypto.verify_sign_batch(items), 1)
+    report("crypto_verify_batch", path="batch", per_s=n / t)
+    processes = os.cpu_count() or 1
+    t = best_time(lambda: crypto.verify_sign_batch(items, processes), 1)
+    report("crypto_verify_batch", path="batch_processes", processes=processes, per_s=n / t)
+
+@bench_this
+def crypto_lazy_user_secret():
+    """Cost of a login, which only needs the auth secret, against deriving every key."""
+    server = dummy_server.DummyServer()
+    alice = client.Client("alice", server)
+    alice.register()
+    secret = alice.user_secret
+    n = 1000
+    def derive_all():
+        user_secret = crypto.UserSecret(secret)
+        user_secret.get_auth_secret()
+        user_secret.get_symmetric_key()
+        user_secret.get_signing_secret_key()
+        user_secret.get_encrypt_and_auth_secret_key()
+    t = best_time(lambda: [derive_all() for _ in range(n)])
+    report("crypto_lazy_user_secret", path="derive_all", per_s=n / t)
+    t = best_time(lambda: [client.Client("alice", server, secret).login() for _ in range(n)])
+    report("crypto_lazy_user_secret", path="client_login", per_s=n / t)
+
+@bench_this
+def crypto_derived_key_cache():
+    """Deriving every key for a returning secret, with and without the cache."""
+    secret = crypto.UserSecret().get_secret()
+    n = 1000
+    def derive_all():
+        user_secret = crypto.UserSecret(secret)
+        user_secret.get_auth_secret()
+        user_secret.get_symmetric_key()
+        user_secret.get_signing_secret_key()
+        user_secret.get_encrypt_and_auth_secret_key()
+    t = best_time(lambda: [derive_all() for _ in range(n)])
+    report("crypto_derived_key_cache", path="uncached", per_s=n / t)
+    crypto.enable_derived_key_cache()
+    try:
+        t = best_time(lambda: [derive_all() for _ in range(n)])
+    finally:
+        crypto.disable_derived_key_cache()
+    report("crypto_derived_key_cache", path="cached", per_s=n / t)
+
+@bench_this
+def crypto_streaming_mac():
+    """MAC over a large photo payload, one-shot against chunk by chunk."""
+    mac = crypto.MessageAuthenticationCode()
+    payload = codec.Encoding()
+    for _ in range(16):
+        payload.add_bin(os.urandom(1 << 20))
+    size = len(payload.bytes_data)
+    t = best_time(lambda: mac.gen_mac(payload))
+    report("crypto_streaming_mac", path="gen_mac", mb_per_s=size / t / 1e6)
+    def stream():
+        ctxt = mac.new_mac()
+        ctxt.update(payload)
+        return ctxt.finalize()
+    t = best_time(stream)
+    report("crypto_streaming_mac", path="stream", mb_per_s=size / t / 1e6)
+
+@bench_this
+def crypto_stream_encryption():
+    """Throughput on a 100 MB photo, one SecretBox call against the
+    chunked stream.  The stream never holds more than a record of
+    plaintext or ciphertext beyond what the caller keeps."""
+    size = 100 * (1 << 20)
+    blob = os.urandom(size)
+    prover = crypto.SymmetricKeyEncryption()
+    t = best_time(lambda: prover.box.decrypt(prover.box.encrypt(blob)), 1)
+    report("crypto_stream_encryption", path="secretbox", mb_per_s=size / t / 1e6)
+    view = memoryview(blob)
+    def pieces():
+        for start in range(0, size, crypto.STREAM_CHUNK_SIZE):
+            yield view[start:start + crypto.STREAM_CHUNK_SIZE]
+    def round_trip():
+        for _ in prover.decrypt_stream(prover.encrypt_stream(pieces())):
+            pass
+    t = best_time(round_trip, 1)
+    report("crypto_stream_encryption", path="stream", mb_per_s=size / t / 1e6)
+
+@bench_this
+def crypto_hash_backends():
+    """list_data_hash throughput for each hash backend."""
+    for size in [64, 1 << 16]:
+        data = [codec.encode_one_bin(os.urandom(size)) for _ in range(1000)]
+        total = sum(len(d.bytes_data) for d in data)
+        for algorithm in crypto.HASH_BACKENDS:
+            t = best_time(lambda: crypto.list_data_hash(data, algorithm))
+            report("crypto_hash_backends", algorithm=algorithm, item_bytes=size,
+                   items_per_s=len(data) / t, mb_per_s=total / t / 1e6)
+
+@bench_this
+def crypto_primitives():
+    """Ops/sec and latency percentiles of each primitive across
+    payload sizes.  list_data_hash is given 16 copies of the payload."""
+    def measure(op, size, f):
+        n = max(20, min(1000, (1 << 22) // max(size, 1)))
+        f() # warm up caches and lazy state
+        times = latencies(f, n)
+        report("crypto_primitives", op=op, payload_bytes=size, n=n,
+               ops_per_s=n / sum(times),
+               p50_us=percentile(times, 50) * 1e6,
+               p90_us=percentile(times, 90) * 1e6,
+               p99_us=percentile(times, 99) * 1e6)
+
+    secret = crypto.UserSecret().get_secret()
+    def derive_all():
+        user_secret = crypto.UserSecret(secret)
+        user_secret.get_auth_secret()
+        user_secret.get_symmetric_key()
+        user_secret.get_signing_secret_key()
+        user_secret.get_encrypt_and_auth_secret_key()
+    measure("user_secret_derive", 0, derive_all)
+
+    mac = crypto.MessageAuthenticationCode()
+    signer = crypto.PublicKeySignature()
+    pk = signer.get_public_key()
+    symmetric = crypto.SymmetricKeyEncryption()
+    alice = crypto.PublicKeyEncryptionAndAuthentication()
+    bob = crypto.PublicKeyEncryptionAndAuthentication()
+    alice_pk = bytes(alice.get_public_key())
+    bob_pk = bytes(bob.get_public_key())
+    for size in [64, 1 << 10, 1 << 16, 1 << 20]:
+        payload = codec.encode_one_bin(os.urandom(size))
+        signature = signer.sign(payload)
+        encrypted = symmetric.encrypt(payload)
+        boxed = alice.encrypt_and_auth(payload, bob_pk)
+        measure("gen_mac", size, lambda: mac.gen_mac(payload))
+        measure("list_data_hash", size, lambda: crypto.list_data_hash([payload] * 16))
+        measure("sign", size, lambda: signer.sign(payload))
+        measure("verify_sign", size, lambda: crypto.verify_sign(pk, payload, signature))
+        measure("symmetric_encrypt", size, lambda: symmetric.encrypt(payload))
+        measure("symmetric_decrypt", size, lambda: symmetric.decrypt(encrypted))
+        measure("public_key_encrypt", size, lambda: alice.encrypt_and_auth(payload, bob_pk))
+        measure("public_key_decrypt", size, lambda: bob.decrypt_and_verify(boxed, alice_pk))
+
+def main(args):
+    global json_results
+    prefixes = [a for a in args if a not in ["--json", "--profile"]]
+    if "--json" in args:
+        json_results = []
+    profiler = cProfile.Profile() if "--profile" in args else None
+    for f in benchmarks:
+        if not prefixes or any(f.__name__.startswith(p) for p in prefixes):
+            if profiler is None:
+                f()
+            else:
+                profiler.runcall(f)
+    if profiler is not None:
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(25)
+    if json_results is not None:
+        json.dump(dict(timestamp=time.time(), python=sys.version.split()[0],
+                       results=json_results), sys.stdout, indent=1)
+        print()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -7,9 +7,12 @@ client holds the lab client.
 from dummy_server import *
 from crypto import *
 import api
+from api import PublicProfile
 import codec
 import errors
 import copy
+import functools
+from photo_cache import PhotoCache
 
 class Client:
     """The client for the photo-sharing application.
@@ -26,18 +29,29 @@ class Client:
     verify the authenticity of an update, clients check the
     authenticator using a shared symmetric key.
     """
-    def __init__(self, username, remote, user_secret=None):
+    # how many photos _synchronize fetches per get_photos request
+    photo_batch_size = 256
+    # memory budget for photo blobs, and where blobs over it are spilled
+    # (a temporary directory if None); see PhotoCache
+    photo_cache_bytes = 64 << 20
+    photo_cache_dir = None
+
+    def __init__(self, username, remote, user_secret=None, lazy_photos=False):
         """Initialize a client given a username, a
         remote server, and a user secret.
 
         If no user secret is provided, this constructor generates a
         new one.
 
+        If lazy_photos is set, synchronizing only records the IDs of
+        new photos, and get_photo fetches each blob on first access.
+
         >>> server = DummyServer()
         >>> alice = Client("alice", server)
         >>> alice1 = Client("alice", server, alice.user_secret)
         """
         self._remote = remote
+        self._lazy_photos = lazy_photos
 
         self._username = username
         self._server_session_token = None
@@ -49,18 +63,33 @@ class Client:
 
         # OLD VERSION FROM LAB < 3
         #self._public_profile = PublicProfile(username)
-        
-        self._public_key_signer = PublicKeySignature(self._user_secret.get_signing_secret_key())
 
-        self._public_key_encrypt_and_auth = PublicKeyEncryptionAndAuthentication(self._user_secret.get_encrypt_and_auth_secret_key())
-        self._public_profile = PublicProfile(username, infos={"encrypt_and_auth_public_key":self.encrypt_and_auth_public_key})
-        self._sign_public_profile()
-        self._photos = [] # list of photos in put_photo order
+        # _public_key_signer, _public_key_encrypt_and_auth and
+        # _public_profile are set up on first use (see below), so that
+        # logging in does not derive the public key pairs
+
+        # PhotoCache keys, or _UnfetchedPhoto, in put_photo order
+        self._photos = []
+        self._photo_cache = PhotoCache(self.photo_cache_bytes, self.photo_cache_dir)
         self._next_photo_id = 0
         self._last_log_number = 0
         self._albums = {}
 
 
+    @functools.cached_property
+    def _public_key_signer(self):
+        return PublicKeySignature(self._user_secret.get_signing_secret_key())
+
+    @functools.cached_property
+    def _public_key_encrypt_and_auth(self):
+        return PublicKeyEncryptionAndAuthentication(self._user_secret.get_encrypt_and_auth_secret_key())
+
+    @functools.cached_property
+    def _public_profile(self):
+        public_profile = PublicProfile(self._username, infos={"encrypt_and_auth_public_key":self.encrypt_and_auth_public_key})
+        public_profile.add_metadata(self._public_key_signer.sign(public_profile.encode()))
+        return public_profile
+
     @property
     def username(self):
         """Get the client's username.
@@ -307,7 +336,28 @@ class Client:
 
         if photo_id < 0 or photo_id >= len(self._photos):
             raise errors.PhotoDoesNotExistError(photo_id)
-        return self._photos[photo_id]
+        photo = self._photos[photo_id]
+        if type(photo) is _UnfetchedPhoto:
+            photo_blob = self._fetch_photo(photo.photo_id)
+            self._photos[photo_id] = self._photo_cache.add(photo_blob)
+            return photo_blob
+        return self._photo_cache.get(photo)
+
+    def photo_cache_stats(self):
+        """Report how the photo cache is doing.
+
+        >>> server = DummyServer()
+        >>> alice = Client("alice", server)
+        >>> alice.register()
+        >>> photo_id = alice.put_photo(b'PHOTOOO')
+        >>> alice.get_photo(photo_id)
+        b'PHOTOOO'
+        >>> alice.photo_cache_stats()
+        {'hits': 1, 'misses': 0, 'spills': 0, 'memory_bytes': 7}
+        """
+        cache = self._photo_cache
+        return {"hits": cache.hits, "misses": cache.misses,
+                "spills": cache.spills, "memory_bytes": cache.memory_bytes}
 
     def _fetch_photo(self, photo_id):
         """Get a photo from the server using the unique PhotoID
@@ -335,6 +385,38 @@ class Client:
             raise Exception(resp)
         return resp.photo_blob
 
+    def _iter_fetch_photos(self, photo_ids):
+        """Like _fetch_photos, but yield each photo as its batch arrives."""
+        for start in range(0, len(photo_ids), self.photo_batch_size):
+            batch = photo_ids[start:start + self.photo_batch_size]
+            req = api.GetPhotosRequest(self._username, self._server_session_token, batch)
+            resp = self._remote.get_photos_user(req)
+            if resp.error == api.Errcode.INVALID_TOKEN:
+                raise errors.InvalidTokenError()
+            elif resp.error == api.Errcode.PHOTO_DOES_NOT_EXIST:
+                raise errors.PhotoDoesNotExistError(batch[len(resp.photo_blobs)])
+            elif resp.error is not None:
+                raise Exception(resp)
+            yield from resp.photo_blobs
+
+    def _fetch_photos(self, photo_ids):
+        """Get many photos from the server, photo_batch_size per request.
+
+        >>> server = DummyServer()
+        >>> alice = Client("alice", server)
+        >>> alice.register()
+        >>> alice.photo_batch_size = 2
+        >>> for blob in [b'PHOTO0', b'PHOTO1', b'PHOTO2']:
+        ...     _ = alice.put_photo(blob)
+        >>> alice._fetch_photos([2, 0, 1])
+        [b'PHOTO2', b'PHOTO0', b'PHOTO1']
+        >>> alice._fetch_photos([0, 1, 7])
+        Traceback (most recent call last):
+                ...
+        errors.PhotoDoesNotExistError: photo with ID 7 does not exist
+        """
+        return list(self._iter_fetch_photos(photo_ids))
+
     def put_photo(self, photo_blob):
         """Append a photo_blob to the server's database.
 
@@ -374,7 +456,10 @@ class Client:
         """A convenience method to add a new photo to client records
         under a tag."""
         self._next_photo_id += 1
-        self._photos.append(photo_blob)
+        if type(photo_blob) is _UnfetchedPhoto:
+            self._photos.append(photo_blob)
+        else:
+            self._photos.append(self._photo_cache.add(photo_blob))
         self._last_log_number += 1
 
     def _synchronize(self):
@@ -403,6 +488,23 @@ class Client:
         >>> photo_blob = b'PHOOT0O'
         >>> alicebis.put_photo(photo_blob)
         2
+
+        A lazy client records new photos without fetching them.
+
+        >>> bob = Client("bob", server)
+        >>> bob.register()
+        >>> for blob in [b'PHOTO0', b'PHOTO1']:
+        ...     _ = bob.put_photo(blob)
+        >>> lazy_bob = Client("bob", server, bob.user_secret, lazy_photos=True)
+        >>> lazy_bob.login()
+        >>> lazy_bob.list_photos()
+        [0, 1]
+        >>> lazy_bob._photos[1]
+        _UnfetchedPhoto(photo_id=1)
+        >>> lazy_bob.get_photo(1)
+        b'PHOTO1'
+        >>> type(lazy_bob._photos[1])
+        <class 'bytes'>
         """
         req = api.SynchronizeRequest(self._username,
                                      self._server_session_token,
@@ -416,15 +518,21 @@ class Client:
         elif resp.error is not None:
             raise Exception(resp)
 
-        for encoded in resp.encoded_log_entries:
-            try:
-                log = decode_log_entry(encoded.items())
-            except errors.MalformedEncodingError as e:
-                raise errors.SynchronizationError(e)
+        try:
+            logs = decode_log_entries(join_log_entries(resp.encoded_log_entries))
+        except errors.MalformedEncodingError as e:
+            raise errors.SynchronizationError(e)
+        # fetch new photos in batches rather than one request per photo,
+        # one batch at a time as the log is replayed; lazy clients fetch
+        # them in get_photo instead
+        photo_ids = [log.photo_id for log in logs if log.opcode == api.OperationCode.PUT_PHOTO]
+        if self._lazy_photos:
+            photo_blobs = iter([_UnfetchedPhoto(photo_id) for photo_id in photo_ids])
+        else:
+            photo_blobs = self._iter_fetch_photos(photo_ids)
+        for log in logs:
             if log.opcode == api.OperationCode.PUT_PHOTO:
-                photo_id = log.photo_id
-                photo_blob = self._fetch_photo(photo_id)
-                self._record_new_photo(photo_blob)
+                self._record_new_photo(next(photo_blobs))
             else:
                 self._last_log_number += 1
 
@@ -616,42 +724,100 @@ class Client:
         self._albums[name_album].add_photo(photo)
         self._upload_album(name_album)
 
-class PublicProfile:
-    def __init__(self, username, infos={}):
-        self.username = username
-        self.infos = infos
-        self.metadata = None
+class _UnfetchedPhoto:
+    """A photo recorded by a lazy client but not fetched yet."""
+    __slots__ = ["photo_id"]
 
-    def add_metadata(self, metadata):
-        self.metadata = metadata
+    def __init__(self, photo_id):
+        self.photo_id = photo_id
 
-    def encode(self):
-        encoding = codec.Encoding()
-        encoding.add_bin(self.username.encode('utf-8'))
-        encoding.add_dict(self.infos)
-        return encoding
+    def __repr__(self):
+        return "_UnfetchedPhoto(photo_id={})".format(self.photo_id)
 
-    def verify(self, pk):
-        return verify_sign(pk, self.encode(), self.metadata)
 class LogEntry:
     def __init__(self, opcode, photo_id):
         self.opcode = opcode
         self.photo_id = photo_id
 
+# The layout of a log entry: the ints it is encoded as, in order.  Both
+# the single-entry and the batch encoders and decoders go through these
+# two functions.
+
+def _log_entry_ints(log_entry):
+    return [log_entry.opcode.value, log_entry.photo_id]
+
+def _log_entry_from_ints(ints):
+    try:
+        opcode = api.OperationCode(ints[0])
+    except ValueError:
+        raise errors.MalformedEncodingError("item 0 is not valid opcode {}".format(ints[0]))
+    return LogEntry(opcode, ints[1])
+
+LOG_ENTRY_INTS = len(_log_entry_ints(LogEntry(api.OperationCode.REGISTER, 0)))
+
 def encode_log_entry(encoding, log_entry):
-    encoding.add_int(log_entry.opcode.value)
-    encoding.add_int(log_entry.photo_id)
+    encoding.add_ints(_log_entry_ints(log_entry))
     return encoding
 
 def decode_log_entry(items_iter):
     items = list(items_iter)
-    if len(items) != 2:
-        raise errors.MalformedEncodingError("expected 2 items but got {} items".format(len(items)))
+    if len(items) != LOG_ENTRY_INTS:
+        raise errors.MalformedEncodingError("expected {} items but got {} items".format(
+            LOG_ENTRY_INTS, len(items)))
+    return _log_entry_from_ints(items)
+
+# every log entry is encoded as LOG_ENTRY_INTS ints, so it has a fixed size
+LOG_ENTRY_SIZE = len(encode_log_entry(codec.Encoding(), LogEntry(api.OperationCode.REGISTER, 0)).bytes_data)
+if LOG_ENTRY_SIZE != LOG_ENTRY_INTS * len(codec.encode_one_int(0).bytes_data):
+    raise Exception("log entries must be encoded as exactly LOG_ENTRY_INTS ints")
+
+def encode_log_entries(encoding, log_entries):
+    """Encode log entries back to back, packing all their ints at once.
+
+    >>> logs = [LogEntry(api.OperationCode.REGISTER, 0), LogEntry(api.OperationCode.PUT_PHOTO, 0)]
+    >>> encoding = encode_log_entries(codec.Encoding(), logs)
+    >>> len(encoding.bytes_data) == 2 * LOG_ENTRY_SIZE
+    True
+    >>> [(log.opcode.name, log.photo_id) for log in decode_log_entries(encoding)]
+    [('REGISTER', 0), ('PUT_PHOTO', 0)]
+    """
+    ints = []
+    for log_entry in log_entries:
+        ints += _log_entry_ints(log_entry)
+    encoding.add_ints(ints)
+    return encoding
+
+def join_log_entries(encodings):
+    """Concatenate separately encoded log entries into one buffer.
+
+    >>> entry = encode_log_entry(codec.Encoding(), LogEntry(api.OperationCode.PUT_PHOTO, 7))
+    >>> len(decode_log_entries(join_log_entries([entry, entry])))
+    2
+    >>> join_log_entries([codec.encode_one_int(1)])
+    Traceback (most recent call last):
+            ...
+    errors.MalformedEncodingError: provided encoding was malformed: log entry 0 has 9 bytes but expected 18
+    """
+    for i, encoding in enumerate(encodings):
+        size = len(encoding.bytes_data)
+        if size != LOG_ENTRY_SIZE:
+            raise errors.MalformedEncodingError("log entry {} has {} bytes but expected {}".format(
+                i, size, LOG_ENTRY_SIZE))
+    return codec.Encoding(b"".join(encoding.bytes_data for encoding in encodings))
+
+def decode_log_entries(encoding):
+    """Decode a buffer of back-to-back log entries in a single pass."""
+    size = len(encoding.bytes_data)
+    if size % LOG_ENTRY_SIZE != 0:
+        raise errors.MalformedEncodingError("log entries have {} bytes, not a multiple of {}".format(
+            size, LOG_ENTRY_SIZE))
+    count = LOG_ENTRY_INTS * (size // LOG_ENTRY_SIZE)
     try:
-        api.OperationCode(items[0])
-    except ValueError:
-        raise errors.MalformedEncodingError("item 0 is not valid opcode {}".format(items[0]))
-    return LogEntry(api.OperationCode(items[0]), items[1])
+        ints = codec.Decoder(encoding.bytes_data, compact=False).next_ints(count)
+    except (codec.UnexpectedSeparatorError, codec.TruncatedEncodingError):
+        raise errors.MalformedEncodingError("log entries must contain only ints")
+    return [_log_entry_from_ints(ints[i:i + LOG_ENTRY_INTS])
+            for i in range(0, len(ints), LOG_ENTRY_INTS)]
 
 
 if __name__ == "__main__":
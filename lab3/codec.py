@@ -4,11 +4,73 @@
 A simple codec for encoding arbitrary data as bytes.
 """
 
+import functools
+import itertools
+import struct
+
 BIN_SEPARATOR = b'\x01'
 INT_SEPARATOR = b'\x02'
 PAIR_SEPARATOR = b'\x03'
 DICT_SEPARATOR = b'\x04'
 STR_SEPARATOR  = b'\x05'
+SORTED_DICT_SEPARATOR = b'\x06'
+
+# Compact encodings start with this version byte and store ints and
+# lengths as LEB128 varints.  It is never a valid separator, so both
+# formats can be told apart from their first byte.
+COMPACT_VERSION = b'\x80'
+
+# an encoded int: its separator followed by 8 little-endian bytes
+_INT_ITEM = struct.Struct('<cQ')
+# the header of a fixed-width bin: its separator and its encoded length
+_BIN_HEADER = struct.Struct('<ccQ')
+
+# bulk int reads and writes go through blocks of at most this many ints,
+# so their temporary objects stay small whatever the total count
+_INT_BLOCK = 256
+
+@functools.lru_cache(maxsize=None)
+def _int_items_struct(n):
+    return struct.Struct('<' + 'cQ' * n)
+
+def _varint(int_data):
+    if int_data < 0x80:
+        return bytes([int_data])
+    data = bytearray()
+    while int_data >= 0x80:
+        data.append((int_data & 0x7F) | 0x80)
+        int_data >>= 7
+    data.append(int_data)
+    return data
+
+def _check_int(int_data):
+    if type(int_data) != int:
+        raise TypeError("int_data must be int")
+    if int_data > 2**64 - 1:
+        raise Exception("Integer is too large to encode {}".format(int_data))
+    if int_data < 0:
+        raise Exception("Integer cannot be negative {}".format(int_data))
+
+class TruncatedEncodingError(Exception):
+    """Raised when an encoding ends in the middle of an item.
+
+    needed is the buffer length required before decoding can make
+    further progress."""
+    def __init__(self, offset, needed):
+        self.offset = offset
+        self.needed = needed
+    def __str__(self):
+        return "Encoding truncated at offset {}".format(self.offset)
+
+class UnexpectedSeparatorError(Exception):
+    """Raised when the item at offset is not of the kind being read."""
+    def __init__(self, offset, expected, found):
+        self.offset = offset
+        self.expected = expected
+        self.found = found
+    def __str__(self):
+        return "Expected separator {} but found {} at offset {}".format(
+            self.expected, self.found, self.offset)
 
 def encode_one_int(num):
     """Convenience function for encoding a single int."""
@@ -27,7 +89,7 @@ def encode_one_bin(bin_data):
     return enc
     
 class Encoding:
-    def __init__(self, bytes_data=b""):
+    def __init__(self, bytes_data=b"", compact=False):
         """Holds the encoding for a sequence of data, which may
         contain raw bytes or unsigned 64-bit integers.
 
@@ -37,53 +99,206 @@ class Encoding:
         >>> list(x.items())
         [4, b'string']
 
+        Items are appended to a growable buffer, so building an
+        encoding of n items takes O(n) time.  The buffer is finalized
+        into an immutable bytes object the first time bytes_data is
+        read after a change, and the buffer is then released.
+
+        >>> x = Encoding()
+        >>> for i in range(3):
+        ...     x.add_int(i)
+        >>> len(x.bytes_data)
+        27
+        >>> x.add_string("more")
+        >>> x.decode()
+        [0, 1, 2, 'more']
+        >>> Encoding(x.bytes_data).bytes_data == x.bytes_data
+        True
+
+        A compact encoding stores ints and lengths as varints after a
+        version byte.  It decodes to the same items.
+
+        >>> y = Encoding(compact=True)
+        >>> for i in range(3):
+        ...     y.add_int(i)
+        >>> y.add_string("more")
+        >>> len(y.bytes_data)
+        15
+        >>> Encoding(y.bytes_data).decode()
+        [0, 1, 2, 'more']
         """
+        if compact and len(bytes_data) == 0:
+            bytes_data = COMPACT_VERSION
         self.bytes_data = bytes_data
 
+    @property
+    def bytes_data(self):
+        if self._bytes_data is None:
+            self._bytes_data = bytes(self._buf)
+            # keep one copy; _append rebuilds the buffer if needed
+            self._buf = None
+        return self._bytes_data
+
+    @bytes_data.setter
+    def bytes_data(self, bytes_data):
+        self._bytes_data = bytes(bytes_data)
+        self._buf = None
+        self.compact = self._bytes_data[0:1] == COMPACT_VERSION
+
+    def _body(self, encoding):
+        """Get the items of encoding, which must use the same format."""
+        if encoding.compact != self.compact:
+            raise Exception("Cannot mix compact and fixed-width encodings")
+        if encoding.compact:
+            return encoding.bytes_data[1:]
+        return encoding.bytes_data
+
+    def _size(self):
+        if self._buf is None:
+            return len(self._bytes_data)
+        return len(self._buf)
+
+    def _append(self, data):
+        if self._buf is None:
+            self._buf = bytearray(self._bytes_data)
+        self._buf += data
+        self._bytes_data = None
+
     def add_int(self, int_data):
-        if type(int_data) != int:
-            raise TypeError("int_data must be int")
-        if int_data > 2**64 - 1:
-            raise Exception("Integer is too large to encode {}".format(int_data))
-        if int_data < 0:
-            raise Exception("Integer cannot be negative {}".format(int_data))
-        data = [
-            (int_data >> (8 * 0)) & 0xFF,
-            (int_data >> (8 * 1)) & 0xFF,
-            (int_data >> (8 * 2)) & 0xFF,
-            (int_data >> (8 * 3)) & 0xFF,
-            (int_data >> (8 * 4)) & 0xFF,
-            (int_data >> (8 * 5)) & 0xFF,
-            (int_data >> (8 * 6)) & 0xFF,
-            (int_data >> (8 * 7)) & 0xFF,
-        ]
-        self.bytes_data += INT_SEPARATOR
-        self.bytes_data += bytes(data)
+        _check_int(int_data)
+        if self.compact:
+            self._append(INT_SEPARATOR)
+            self._append(_varint(int_data))
+        else:
+            self._append(_INT_ITEM.pack(INT_SEPARATOR, int_data))
+
+    def add_ints(self, ints):
+        """Append a sequence of ints in a single call.
+
+        The result is the same as calling add_int on each of them.
+
+        >>> x = Encoding()
+        >>> x.add_ints(range(3))
+        >>> y = Encoding()
+        >>> for i in range(3):
+        ...     y.add_int(i)
+        >>> x.bytes_data == y.bytes_data
+        True
+        >>> Decoder(x.bytes_data).next_ints(3)
+        [0, 1, 2]
+
+        If any int cannot be encoded, the encoding is left unchanged.
+
+        >>> y = Encoding(compact=True)
+        >>> y.add_ints([1, 2, -1])
+        Traceback (most recent call last):
+                ...
+        Exception: Integer cannot be negative -1
+        >>> y.bytes_data
+        b'\\x80'
+        """
+        start = self._size()
+        try:
+            if self.compact:
+                for int_data in ints:
+                    self.add_int(int_data)
+            else:
+                self._add_fixed_ints(ints)
+        except Exception:
+            if self._buf is not None:
+                del self._buf[start:]
+            raise
+
+    def _add_fixed_ints(self, ints):
+        ints = iter(ints)
+        while True:
+            block = list(itertools.islice(ints, _INT_BLOCK))
+            if len(block) == 0:
+                break
+            args = [INT_SEPARATOR] * (2 * len(block))
+            args[1::2] = block
+            for int_data in block:
+                if type(int_data) != int:
+                    raise TypeError("int_data must be int")
+            try:
+                self._append(_int_items_struct(len(block)).pack(*args))
+            except struct.error:
+                # find the int that did not fit, for the same error as add_int
+                for int_data in block:
+                    _check_int(int_data)
+                raise
 
     def add_bin(self, bin_data):
         if type(bin_data) != bytes:
             raise TypeError("bin_data must be bytes")
-        self.bytes_data += BIN_SEPARATOR
-        self.add_int(len(bin_data))
-        self.bytes_data += bin_data
+        if self.compact:
+            self._append(BIN_SEPARATOR)
+            self.add_int(len(bin_data))
+        else:
+            self._append(_BIN_HEADER.pack(BIN_SEPARATOR, INT_SEPARATOR, len(bin_data)))
+        self._append(bin_data)
 
     def add_pair(self, encoding_key, encoding_value):
-        self.bytes_data += PAIR_SEPARATOR
-        self.bytes_data += encoding_key.bytes_data
-        self.bytes_data += encoding_value.bytes_data
+        self._append(PAIR_SEPARATOR)
+        self._append(self._body(encoding_key))
+        self._append(self._body(encoding_value))
 
     def add_dict(self, dict_data):
-        self.bytes_data += DICT_SEPARATOR
+        self._append(DICT_SEPARATOR)
         self.add_int(len(dict_data))
         for k,v in dict_data.items():
-            enc_k = Encoding()
-            enc_k.add_obj(k)
-            enc_v = Encoding()
-            enc_v.add_obj(v)
-            self.add_pair(enc_k, enc_v)
+            self._append(PAIR_SEPARATOR)
+            self.add_obj(k)
+            self.add_obj(v)
     
+    def add_sorted_dict(self, dict_data):
+        """Append a dict in canonical form: pairs sorted by encoded key,
+        preceded by an index of their offsets.
+
+        The header holds the number of pairs, the length of the pairs and
+        one int offset per pair, so Decoder.lookup() can binary search a
+        single key without decoding the whole dict.  Equal dicts always
+        have the same encoding, whatever their insertion order.
+
+        >>> x = Encoding()
+        >>> x.add_sorted_dict({"b": 2, "a": b"1"})
+        >>> y = Encoding()
+        >>> y.add_sorted_dict({"a": b"1", "b": 2})
+        >>> x.bytes_data == y.bytes_data
+        True
+        >>> x.decode()
+        {'a': b'1', 'b': 2}
+        >>> Decoder(x.bytes_data).lookup("b")
+        2
+        """
+        body = Encoding(compact=self.compact)
+        pairs = []
+        for k,v in dict_data.items():
+            if type(k) not in (int, str, bytes):
+                raise TypeError("dict keys must be int, str or bytes")
+            start = body._size()
+            body._append(PAIR_SEPARATOR)
+            body.add_obj(k)
+            key_end = body._size()
+            body.add_obj(v)
+            pairs.append((body._buf[start + 1:key_end], start, body._size()))
+        pairs.sort()
+        body_data = body.bytes_data
+        offsets = []
+        pairs_len = 0
+        for (_, start, end) in pairs:
+            offsets.append(pairs_len)
+            pairs_len += end - start
+        self._append(SORTED_DICT_SEPARATOR)
+        self.add_int(len(pairs))
+        self.add_int(pairs_len)
+        # the index stays fixed-width in both formats so it can be searched
+        self._add_fixed_ints(offsets)
+        for (_, start, end) in pairs:
+            self._append(body_data[start:end])
+
     def add_string(self, string):
-        self.bytes_data += STR_SEPARATOR
+        self._append(STR_SEPARATOR)
         self.add_bin(string.encode('utf-8'))
 
     def add_obj(self, obj):
@@ -104,22 +319,50 @@ class Encoding:
             raise TypeError("type of obj is not encodable")
 
     def items(self):
-        copy = Encoding(bytes(self.bytes_data))
-        while len(copy.bytes_data) > 0:
-            kind = copy.bytes_data[0:1]
-            if kind == INT_SEPARATOR:
-                yield copy._next_int()
-            elif kind == BIN_SEPARATOR:
-                yield copy._next_bin()
-            elif kind == PAIR_SEPARATOR:
-                yield copy._next_pair()
-            elif kind == DICT_SEPARATOR:
-                yield copy._next_dict()
-            elif kind == STR_SEPARATOR:
-                yield copy._next_str()
-            else:
-                raise Exception("Found unknown separator {} while decoding".format(kind))
+        decoder = Decoder(self.bytes_data)
+        end = len(decoder._view)
+        while decoder.offset < end:
+            yield decoder.next_item()
+
+    def items_with_offsets(self, zero_copy=False):
+        """Iterate over (offset, item) pairs without copying the buffer.
+
+        If zero_copy is set, binary payloads are returned as read-only
+        memoryview slices of bytes_data instead of bytes.
+
+        >>> x = Encoding()
+        >>> x.add_int(7)
+        >>> x.add_bin(b"blob")
+        >>> x.add_string("s")
+        >>> list(x.items_with_offsets())
+        [(0, 7), (9, b'blob'), (23, 's')]
+        >>> [type(item) for _, item in x.items_with_offsets(zero_copy=True)]
+        [<class 'int'>, <class 'memoryview'>, <class 'str'>]
+        """
+        return Decoder(self.bytes_data, zero_copy)
     
+    def chunks(self, chunk_size=1 << 16):
+        """Iterate over read-only slices of the encoded bytes, at most
+        chunk_size long, without finalizing or copying the buffer.  The
+        buffer must not be changed until iteration is done.
+
+        >>> x = Encoding()
+        >>> x.add_bin(b"abc")
+        >>> x.add_int(1)
+        >>> [len(c) for c in x.chunks(8)]
+        [8, 8, 6]
+        >>> b"".join(x.chunks(8)) == x.bytes_data
+        True
+        """
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+        if self._buf is None:
+            view = memoryview(self._bytes_data)
+        else:
+            view = memoryview(self._buf).toreadonly()
+        for start in range(0, len(view), chunk_size):
+            yield view[start:start + chunk_size]
+
     def decode(self):
         ret = list(self.items())
         if len(ret) == 1:
@@ -127,69 +370,403 @@ class Encoding:
         else:
             return ret
 
-    def _next_int(self):
-        assert(self.bytes_data[0:1] == INT_SEPARATOR)
-        self.bytes_data = self.bytes_data[1:]
+class Decoder:
+    def __init__(self, bytes_data, zero_copy=False, compact=None):
+        """A cursor over an encoded buffer.
+
+        Items are read in place, so decoding never copies the remaining
+        buffer.  A memoryview is only taken when the input is not bytes
+        or zero_copy is set, which keeps small decodes cheap.  Iterating
+        yields (offset, item) pairs, where offset is the position of the
+        item's separator.
+
+        >>> x = Encoding()
+        >>> x.add_dict({"k": 1})
+        >>> x.add_bin(b"data")
+        >>> d = Decoder(x.bytes_data, zero_copy=True)
+        >>> d.next_item()
+        {'k': 1}
+        >>> d.offset
+        32
+        >>> bytes(d.next_item())
+        b'data'
+        >>> d.at_end()
+        True
+        >>> Decoder(b"\\x02\\x01").next_item()
+        Traceback (most recent call last):
+                ...
+        TruncatedEncodingError: Encoding truncated at offset 0
+
+        The format is detected from the version byte unless compact is
+        given, e.g. when decoding the middle of a compact stream.
+        """
+        if type(bytes_data) is bytes and not zero_copy:
+            # slicing bytes copies no more than bytes() of a view would
+            self._view = bytes_data
+        else:
+            self._view = memoryview(bytes_data).cast('B')
+        self._zero_copy = zero_copy
+        self.offset = 0
+        if compact is None:
+            compact = self._view[0:1] == COMPACT_VERSION
+            if compact:
+                self.offset = 1
+        self.compact = compact
+
+    def __iter__(self):
+        while not self.at_end():
+            offset = self.offset
+            yield (offset, self.next_item())
 
-        data = self.bytes_data[0:8]
-        self.bytes_data = self.bytes_data[8:]
+    def at_end(self):
+        return self.offset >= len(self._view)
 
-        return (
-            (data[0] << (8 * 0)) +
-            (data[1] << (8 * 1)) +
-            (data[2] << (8 * 2)) +
-            (data[3] << (8 * 3)) +
-            (data[4] << (8 * 4)) +
-            (data[5] << (8 * 5)) +
-            (data[6] << (8 * 6)) +
-            (data[7] << (8 * 7)) +
-        0)
+    def next_item(self):
+        kind = self._peek()
+        if kind == INT_SEPARATOR[0]:
+            return self.next_int()
+        elif kind == BIN_SEPARATOR[0]:
+            return self.next_bin(self._zero_copy)
+        elif kind == PAIR_SEPARATOR[0]:
+            return self._next_pair()
+        elif kind == DICT_SEPARATOR[0]:
+            return self.next_dict()
+        elif kind == STR_SEPARATOR[0]:
+            return self.next_str()
+        elif kind == SORTED_DICT_SEPARATOR[0]:
+            return self.next_sorted_dict()
+        else:
+            raise Exception("Found unknown separator {} while decoding".format(bytes([kind])))
+
+    def _peek(self):
+        offset = self.offset
+        if offset >= len(self._view):
+            raise TruncatedEncodingError(offset, offset + 1)
+        return self._view[offset]
 
-    def _next_bin(self):
-        assert(self.bytes_data[0:1] == BIN_SEPARATOR)
-        self.bytes_data = self.bytes_data[1:]
+    def _take(self, size):
+        start = self.offset
+        end = start + size
+        if end > len(self._view):
+            raise TruncatedEncodingError(start, end)
+        self.offset = end
+        return self._view[start:end]
 
-        bin_len = self._next_int()
+    def _expect(self, separator):
+        found = self._peek()
+        if found != separator[0]:
+            raise UnexpectedSeparatorError(self.offset, separator, bytes([found]))
+        self.offset += 1
 
-        data = self.bytes_data[:bin_len]
-        self.bytes_data = self.bytes_data[bin_len:]
+    def next_int(self):
+        if self.compact:
+            self._expect(INT_SEPARATOR)
+            return self._next_varint()
+        return self._next_fixed_int()
 
-        return data
+    def _next_varint(self):
+        start = self.offset
+        int_data = 0
+        shift = 0
+        while True:
+            byte = self._peek()
+            self.offset += 1
+            int_data |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+            if shift >= 70:
+                raise Exception("Varint too long at offset {}".format(start))
+        if int_data > 2**64 - 1:
+            raise Exception("Integer is too large to decode at offset {}".format(start))
+        return int_data
+
+    def _next_fixed_int(self):
+        start = self.offset
+        end = start + _INT_ITEM.size
+        if end > len(self._view):
+            raise TruncatedEncodingError(start, end)
+        (separator, int_data) = _INT_ITEM.unpack_from(self._view, start)
+        if separator != INT_SEPARATOR:
+            raise UnexpectedSeparatorError(start, INT_SEPARATOR, separator)
+        self.offset = end
+        return int_data
+
+    def next_ints(self, n):
+        """Read n consecutive ints in a single call.
+
+        >>> x = Encoding()
+        >>> x.add_ints([5, 2**64 - 1])
+        >>> x.add_bin(b"tail")
+        >>> d = Decoder(x.bytes_data)
+        >>> d.next_ints(2)
+        [5, 18446744073709551615]
+        >>> d.next_item()
+        b'tail'
+        >>> Decoder(x.bytes_data).next_ints(3)
+        Traceback (most recent call last):
+                ...
+        UnexpectedSeparatorError: Expected separator b'\\x02' but found b'\\x01' at offset 18
+        """
+        if self.compact:
+            start = self.offset
+            try:
+                return [self.next_int() for _ in range(n)]
+            except UnexpectedSeparatorError:
+                self.offset = start
+                raise
+        start = self.offset
+        self._take(n * _INT_ITEM.size)
+        ints = []
+        for first in range(0, n, _INT_BLOCK):
+            count = min(_INT_BLOCK, n - first)
+            block_start = start + first * _INT_ITEM.size
+            values = _int_items_struct(count).unpack_from(self._view, block_start)
+            separators = values[0::2]
+            if separators.count(INT_SEPARATOR) != count:
+                self.offset = start
+                i = next(i for i, separator in enumerate(separators) if separator != INT_SEPARATOR)
+                raise UnexpectedSeparatorError(block_start + i * _INT_ITEM.size, INT_SEPARATOR, separators[i])
+            ints += values[1::2]
+        return ints
+
+    def next_bin(self, zero_copy=False):
+        start = self.offset
+        end = start + _BIN_HEADER.size
+        if self.compact or end > len(self._view):
+            self._expect(BIN_SEPARATOR)
+            bin_len = self.next_int()
+        else:
+            (separator, int_separator, bin_len) = _BIN_HEADER.unpack_from(self._view, start)
+            if separator != BIN_SEPARATOR:
+                raise UnexpectedSeparatorError(start, BIN_SEPARATOR, separator)
+            if int_separator != INT_SEPARATOR:
+                raise UnexpectedSeparatorError(start + 1, INT_SEPARATOR, int_separator)
+            self.offset = end
+        data = self._take(bin_len)
+        if zero_copy:
+            return data
+        return bytes(data)
+
+    def _next_key_or_value(self, zero_copy):
+        kind = self._peek()
+        if kind == INT_SEPARATOR[0]:
+            return self.next_int()
+        elif kind == STR_SEPARATOR[0]:
+            return self.next_str()
+        elif kind == BIN_SEPARATOR[0]:
+            return self.next_bin(zero_copy)
+        else:
+            raise Exception("Found unknown separator {} while decoding".format(bytes([kind])))
 
     def _next_pair(self):
-        assert(self.bytes_data[0:1] == PAIR_SEPARATOR)
-        self.bytes_data = self.bytes_data[1:]
-        key_kind = self.bytes_data[0:1]
-        if key_kind == INT_SEPARATOR:
-            key = self._next_int()
-        elif key_kind == STR_SEPARATOR:
-            key = self._next_str()
-        elif key_kind == BIN_SEPARATOR:
-            key = self._next_bin()
-        value_kind = self.bytes_data[0:1]
-        if value_kind == INT_SEPARATOR:
-            value = self._next_int()
-        elif value_kind == STR_SEPARATOR:
-            value = self._next_str()
-        elif value_kind == BIN_SEPARATOR:
-            value = self._next_bin()
+        self._expect(PAIR_SEPARATOR)
+        # keys are always copied so they stay hashable and comparable
+        key = self._next_key_or_value(False)
+        value = self._next_key_or_value(self._zero_copy)
         return (key, value)
         
-    def _next_dict(self):
-        assert(self.bytes_data[0:1] == DICT_SEPARATOR)
-        self.bytes_data = self.bytes_data[1:]
+    def next_dict(self):
+        self._expect(DICT_SEPARATOR)
         ret = {}
-        size = self._next_int()
+        size = self.next_int()
         for _ in range(size):
             pair = self._next_pair()
             ret[pair[0]] = pair[1]
         return ret
 
-    def _next_str(self):
-        assert(self.bytes_data[0:1] == STR_SEPARATOR)
-        self.bytes_data = self.bytes_data[1:]
-        enc = self._next_bin()
-        return enc.decode('utf-8')
+    def _sorted_dict_header(self):
+        self._expect(SORTED_DICT_SEPARATOR)
+        size = self.next_int()
+        pairs_len = self.next_int()
+        index = self.offset
+        self._take(size * _INT_ITEM.size)
+        return (size, pairs_len, index)
+
+    def next_sorted_dict(self):
+        (size, _, _) = self._sorted_dict_header()
+        ret = {}
+        for _ in range(size):
+            pair = self._next_pair()
+            ret[pair[0]] = pair[1]
+        return ret
+
+    def lookup(self, key):
+        """Look up key in the sorted dict at the cursor in O(log n),
+        without decoding the other pairs.  The cursor does not move.
+
+        >>> x = Encoding()
+        >>> x.add_int(1)
+        >>> x.add_sorted_dict({i: str(i) for i in range(100)})
+        >>> d = Decoder(x.bytes_data)
+        >>> d.next_int()
+        1
+        >>> d.lookup(42)
+        '42'
+        >>> d.lookup(100)
+        Traceback (most recent call last):
+                ...
+        KeyError: 100
+        >>> len(d.next_sorted_dict())
+        100
+        >>> d.lookup([5])
+        Traceback (most recent call last):
+                ...
+        TypeError: dict keys must be int, str or bytes
+        """
+        if type(key) not in (int, str, bytes):
+            raise TypeError("dict keys must be int, str or bytes")
+        probe = Encoding(compact=self.compact)
+        probe.add_obj(key)
+        probe = probe.bytes_data[1:] if self.compact else probe.bytes_data
+        start = self.offset
+        try:
+            (size, _, index) = self._sorted_dict_header()
+            pairs_start = self.offset
+            lo = 0
+            hi = size
+            while lo < hi:
+                mid = (lo + hi) // 2
+                self.offset = index + mid * _INT_ITEM.size
+                pair = pairs_start + self._next_fixed_int()
+                self.offset = pair
+                self._expect(PAIR_SEPARATOR)
+                self._next_key_or_value(False)
+                found = bytes(self._view[pair + 1:self.offset])
+                if found == probe:
+                    return self._next_key_or_value(self._zero_copy)
+                elif found < probe:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            raise KeyError(key)
+        finally:
+            self.offset = start
+
+    def next_str(self):
+        self._expect(STR_SEPARATOR)
+        return str(self.next_bin(True), 'utf-8')
+
+class IncrementalDecoder:
+    def __init__(self, zero_copy=False):
+        """Decode an encoding that arrives in chunks, e.g. from a socket.
+
+        feed() returns every item completed by the new chunk.  Only the
+        bytes of the item currently being read are buffered, and no
+        decoding is attempted until enough bytes have arrived to make
+        progress on it.
+
+        >>> x = Encoding()
+        >>> x.add_int(3)
+        >>> x.add_bin(b"photo")
+        >>> x.add_dict({"a": "b"})
+        >>> data = x.bytes_data
+        >>> d = IncrementalDecoder()
+        >>> d.feed(data[:5])
+        []
+        >>> d.feed(data[5:20])
+        [3]
+        >>> d.feed(data[20:])
+        [b'photo', {'a': 'b'}]
+        >>> d.offset == len(data)
+        True
+        >>> d.feed(data[:3])
+        []
+        >>> d.close()
+        Traceback (most recent call last):
+                ...
+        TruncatedEncodingError: Encoding truncated at offset 59
+
+        A dict is read one pair at a time, keeping the pairs read so
+        far, so each byte of a large dict is only parsed once.
+
+        >>> x = Encoding()
+        >>> x.add_sorted_dict({i: str(i) for i in range(50)})
+        >>> x.add_dict({})
+        >>> data = x.bytes_data
+        >>> d = IncrementalDecoder()
+        >>> items = []
+        >>> for i in range(0, len(data), 7):
+        ...     items += d.feed(data[i:i + 7])
+        >>> items == [{i: str(i) for i in range(50)}, {}]
+        True
+        >>> d.close()
+        """
+        self._zero_copy = zero_copy
+        self._compact = None
+        self._pending = bytearray()
+        self._needed = 1
+        self.offset = 0 # stream offset of the first pending byte
+        # the dict being read: (pairs so far, pairs left, index bytes left)
+        self._dict = None
+
+    def _start_dict(self, decoder):
+        """Read a dict header, or return False if the next item is not a dict."""
+        kind = decoder._peek()
+        if kind == DICT_SEPARATOR[0]:
+            decoder._expect(DICT_SEPARATOR)
+            self._dict = ({}, decoder.next_int(), 0)
+        elif kind == SORTED_DICT_SEPARATOR[0]:
+            decoder._expect(SORTED_DICT_SEPARATOR)
+            size = decoder.next_int()
+            decoder.next_int() # pairs_len
+            # the offset index is only needed for lookup(), so skip it
+            self._dict = ({}, size, size * _INT_ITEM.size)
+        else:
+            return False
+        return True
+
+    def _continue_dict(self, decoder):
+        """Read the next part of the current dict: some of its index, or
+        one pair."""
+        (ret, left, skip) = self._dict
+        if skip > 0:
+            n = min(skip, len(decoder._view) - decoder.offset)
+            decoder.offset += n
+            self._dict = (ret, left, skip - n)
+        elif left > 0:
+            (key, value) = decoder._next_pair()
+            ret[key] = value
+            self._dict = (ret, left - 1, 0)
+
+    def feed(self, chunk):
+        self._pending += chunk
+        if len(self._pending) < self._needed:
+            return []
+        if self._compact is None:
+            self._compact = self._pending[0:1] == COMPACT_VERSION
+            if self._compact:
+                del self._pending[0:1]
+                self.offset += 1
+                if len(self._pending) == 0:
+                    return []
+        decoder = Decoder(bytes(self._pending), self._zero_copy, self._compact)
+        items = []
+        while True:
+            if self._dict != None and self._dict[1:] == (0, 0):
+                items.append(self._dict[0])
+                self._dict = None
+            if decoder.at_end():
+                self._needed = 1
+                break
+            start = decoder.offset
+            try:
+                if self._dict != None:
+                    self._continue_dict(decoder)
+                elif not self._start_dict(decoder):
+                    items.append(decoder.next_item())
+            except TruncatedEncodingError as e:
+                decoder.offset = start
+                self._needed = e.needed - start
+                break
+        del self._pending[:decoder.offset]
+        self.offset += decoder.offset
+        return items
+
+    def close(self):
+        """Check that the stream ended on an item boundary."""
+        if len(self._pending) > 0 or self._dict != None:
+            raise TruncatedEncodingError(self.offset, self.offset + self._needed)
 
 if __name__ == "__main__":
     import doctest
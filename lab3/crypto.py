@@ -3,10 +3,27 @@
 import secrets 
 import hmac
 import hashlib
+import os
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from nacl.signing import SigningKey, VerifyKey
 from nacl.public import PrivateKey, PublicKey, Box
 from nacl.secret import SecretBox
 from nacl.utils import random
+from nacl.exceptions import CryptoError
+from nacl.bindings import (
+    crypto_secretstream_xchacha20poly1305_ABYTES as _STREAM_ABYTES,
+    crypto_secretstream_xchacha20poly1305_HEADERBYTES as _STREAM_HEADERBYTES,
+    crypto_secretstream_xchacha20poly1305_TAG_FINAL as _STREAM_TAG_FINAL,
+    crypto_secretstream_xchacha20poly1305_TAG_MESSAGE as _STREAM_TAG_MESSAGE,
+    crypto_secretstream_xchacha20poly1305_init_pull,
+    crypto_secretstream_xchacha20poly1305_init_push,
+    crypto_secretstream_xchacha20poly1305_pull,
+    crypto_secretstream_xchacha20poly1305_push,
+    crypto_secretstream_xchacha20poly1305_state,
+)
 import nacl
 
 import codec
@@ -15,6 +32,100 @@ import codec
 
 hash_function = hashlib.sha3_256
 
+# the hash backends for hash chains and Merkle trees, by the name each
+# chain is tagged with; keys and MACs always use hash_function
+HASH_BACKENDS = {
+    "sha3_256": hashlib.sha3_256,
+    "blake2b_256": functools.partial(hashlib.blake2b, digest_size=32),
+    "sha256": hashlib.sha256,
+}
+
+# the backend new chains use unless told otherwise; histories from
+# before chains were tagged use sha3_256
+LEGACY_HASH_BACKEND = "sha3_256"
+hash_backend = LEGACY_HASH_BACKEND
+
+# the size of a bare LEGACY_HASH_BACKEND digest; tagged digests are longer
+_LEGACY_DIGEST_SIZE = 32
+
+def set_hash_backend(algorithm):
+    """Select the backend new chains use in this deployment.
+
+    Everything that hashes (to_hlist, list_data_hash, _HashChain,
+    ListDataHashAccumulator and MerkleTree) uses the deployment's
+    backend unless given an algorithm.  The digests they return are
+    tagged with their backend, and verification follows the tag, so
+    digests made before a switch still verify after it.
+
+    >>> enc = codec.encode_one_int
+    >>> data = [enc(9), enc(4)]
+    >>> old_hash = list_data_hash(data)
+    >>> old_tree = MerkleTree(to_hlist(data))
+    >>> set_hash_backend("blake2b_256")
+    >>> verify_list_data_hash(data, old_hash)
+    True
+    >>> verify_inclusion(to_hlist(data, algorithm=LEGACY_HASH_BACKEND)[1], 1, 2,
+    ...                  old_tree.inclusion_proof(1), old_tree.root())
+    True
+    >>> new_hash = list_data_hash(data)
+    >>> verify_list_data_hash(data, new_hash), new_hash == old_hash
+    (True, False)
+    >>> hlist = to_hlist(data)
+    >>> tree = MerkleTree(hlist)
+    >>> verify_inclusion(hlist[1], 1, 2, tree.inclusion_proof(1), tree.root())
+    True
+    >>> set_hash_backend(LEGACY_HASH_BACKEND)
+    >>> verify_list_data_hash(data, new_hash)
+    True
+
+    >>> set_hash_backend("md5")
+    Traceback (most recent call last):
+            ...
+    ValueError: unknown hash backend 'md5'
+    """
+    global hash_backend
+    get_hash_backend(algorithm)
+    hash_backend = algorithm
+
+def get_hash_backend(algorithm=None):
+    """Get the hash constructor for algorithm, or for the deployment's
+    backend if algorithm is None."""
+    if algorithm == None:
+        algorithm = hash_backend
+    if algorithm not in HASH_BACKENDS:
+        raise ValueError("unknown hash backend {!r}".format(algorithm))
+    return HASH_BACKENDS[algorithm]
+
+def _tag_digest(digest, algorithm):
+    """Tag a digest with the name of its backend.
+
+    A tagged digest is the bytes of an encoding of the name and the
+    digest.  LEGACY_HASH_BACKEND digests stay bare, as they were before
+    digests were tagged.
+    """
+    if algorithm == LEGACY_HASH_BACKEND:
+        return digest
+    tagged = codec.Encoding()
+    tagged.add_string(algorithm)
+    tagged.add_bin(digest)
+    return tagged.bytes_data
+
+def _untag_digest(tagged):
+    """Get (algorithm, digest) from a digest made by _tag_digest, or
+    None if it is malformed or names an unknown backend."""
+    if type(tagged) is not bytes:
+        return None
+    if len(tagged) == _LEGACY_DIGEST_SIZE:
+        return (LEGACY_HASH_BACKEND, tagged)
+    try:
+        items = list(codec.Encoding(tagged).items())
+    except Exception:
+        return None
+    if (len(items) != 2 or type(items[0]) is not str or type(items[1]) is not bytes
+            or items[0] not in HASH_BACKENDS):
+        return None
+    return tuple(items)
+
 class UserSecret:
     """A user secret used for key generation."""
 
@@ -22,15 +133,22 @@ class UserSecret:
         """Wrap secret bytes to generate different user keys.
         If none is provided, generate new secret bytes.
         >>> secret = UserSecret()
+
+        Keys are derived when first requested, so asking only for the
+        auth secret skips the public-key derivations.
+
+        >>> secret.get_auth_secret() == UserSecret(secret.get_secret()).get_auth_secret()
+        True
+        >>> secret._keys.signing_key_pair is None
+        True
         """
         if secret == None:
             self._secret = secrets.token_bytes(32)
         else:
             self._secret = secret
-        self._auth_secret = self._generate_auth_secret()
-        self._symmetric_key = self._generate_symmetric_key()
-        (self._s_sk, self._s_pk) = self._generate_signing_key_pair()
-        (self._e_sk, self._e_pk) = self._generate_encrypt_and_auth_key_pair()
+        # each key is derived on first use and then kept, possibly in
+        # a record shared through the derived key cache
+        self._keys = _get_derived_keys(self._secret)
 
     def _generate_auth_secret(self):
         h_ctxt = hash_function()
@@ -66,22 +184,157 @@ class UserSecret:
         return self._secret
 
     def get_auth_secret(self):
-        return self._auth_secret
+        return self._keys.get("auth_secret", lambda: bytearray(self._generate_auth_secret()))
 
     def get_symmetric_key(self):
-        return self._symmetric_key
+        return self._keys.get("symmetric_key", lambda: bytearray(self._generate_symmetric_key()))
+
+    def _get_signing_key_pair(self):
+        return self._keys.get("signing_key_pair", self._generate_signing_key_pair)
+
+    def _get_encrypt_and_auth_key_pair(self):
+        return self._keys.get("encrypt_and_auth_key_pair", self._generate_encrypt_and_auth_key_pair)
 
     def get_signing_public_key(self):
-        return self._s_pk
+        return self._get_signing_key_pair()[1]
 
     def get_signing_secret_key(self):
-        return self._s_sk
+        return self._get_signing_key_pair()[0]
 
     def get_encrypt_and_auth_public_key(self):
-        return self._e_pk
+        return self._get_encrypt_and_auth_key_pair()[1]
 
     def get_encrypt_and_auth_secret_key(self):
-        return self._e_sk
+        return self._get_encrypt_and_auth_key_pair()[0]
+
+class _DerivedKeys:
+    """The keys derived from one user secret.
+
+    Raw key bytes are held in bytearrays so that wipe() can overwrite
+    them.  Python cannot wipe the immutable copies handed to callers or
+    held inside PyNaCl key objects; wipe() only drops references to
+    those.
+
+    The record may be shared between threads, so every access holds
+    its lock."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.auth_secret = None
+        self.symmetric_key = None
+        self.signing_key_pair = None
+        self.encrypt_and_auth_key_pair = None
+
+    def get(self, name, derive):
+        """Get the key called name, calling derive() to set it if it is
+        missing.  Raw keys are returned as bytes copies."""
+        with self._lock:
+            key = getattr(self, name)
+            if key == None:
+                key = derive()
+                setattr(self, name, key)
+            if type(key) is bytearray:
+                return bytes(key)
+            return key
+
+    def wipe(self):
+        with self._lock:
+            for key in [self.auth_secret, self.symmetric_key]:
+                if key != None:
+                    key[:] = bytes(len(key))
+            self.auth_secret = None
+            self.symmetric_key = None
+            self.signing_key_pair = None
+            self.encrypt_and_auth_key_pair = None
+
+class DerivedKeyCache:
+    def __init__(self, max_entries=64):
+        """A bounded LRU cache of the keys derived from user secrets,
+        keyed by a hash of the secret.  Evicted entries are wiped.
+
+        >>> cache = enable_derived_key_cache(max_entries=1)
+        >>> alice = UserSecret()
+        >>> alice_again = UserSecret(alice.get_secret())
+        >>> alice_again.get_signing_public_key() is alice.get_signing_public_key()
+        True
+        >>> bob = UserSecret()
+        >>> len(cache)
+        1
+        >>> invalidate_derived_keys(bob.get_secret())
+        >>> len(cache)
+        0
+        >>> disable_derived_key_cache()
+        """
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key(self, secret):
+        h_ctxt = hash_function()
+        h_ctxt.update("derived_key_cache".encode('utf-8'))
+        h_ctxt.update(secret)
+        return h_ctxt.digest()
+
+    def get(self, secret):
+        """Get the shared derived keys record for secret, adding it if needed."""
+        key = self._key(secret)
+        evicted = []
+        with self._lock:
+            keys = self._entries.get(key)
+            if keys == None:
+                keys = _DerivedKeys()
+                self._entries[key] = keys
+                while len(self._entries) > self._max_entries:
+                    evicted.append(self._entries.popitem(last=False)[1])
+            else:
+                self._entries.move_to_end(key)
+        for old_keys in evicted:
+            old_keys.wipe()
+        return keys
+
+    def invalidate(self, secret=None):
+        """Wipe and drop the keys derived from secret, or every entry if
+        secret is None."""
+        with self._lock:
+            if secret == None:
+                evicted = list(self._entries.values())
+                self._entries.clear()
+            else:
+                evicted = [self._entries.pop(self._key(secret), _DerivedKeys())]
+        for keys in evicted:
+            keys.wipe()
+
+# the process-wide derived key cache; None unless enabled
+_derived_key_cache = None
+
+def enable_derived_key_cache(max_entries=64):
+    """Share derived keys between UserSecrets built from the same secret."""
+    global _derived_key_cache
+    disable_derived_key_cache()
+    _derived_key_cache = DerivedKeyCache(max_entries)
+    return _derived_key_cache
+
+def disable_derived_key_cache():
+    global _derived_key_cache
+    (cache, _derived_key_cache) = (_derived_key_cache, None)
+    if cache != None:
+        cache.invalidate()
+
+# the functions below read the global once, since another thread may
+# disable the cache at any time
+
+def invalidate_derived_keys(secret=None):
+    cache = _derived_key_cache
+    if cache != None:
+        cache.invalidate(secret)
+
+def _get_derived_keys(secret):
+    cache = _derived_key_cache
+    if cache == None:
+        return _DerivedKeys()
+    return cache.get(secret)
 
 class MessageAuthenticationCode:
     """A wrapper for symmetric keys to produce message authentication codes."""
@@ -130,6 +383,73 @@ class MessageAuthenticationCode:
         """
         return hmac.compare_digest(hmac.new(self._secret_key, data.bytes_data, hash_function).digest(), auth)
 
+    def new_mac(self):
+        """Start an incremental message authenticator.
+
+        The result is the same as gen_mac over the concatenation of
+        everything passed to update().
+
+        >>> prover = MessageAuthenticationCode("fake_secret_key".encode('utf-8'))
+        >>> payload = codec.Encoding()
+        >>> payload.add_bin(b"Hello ")
+        >>> payload.add_bin("Security!".encode('utf-8'))
+        >>> payload.add_int(1)
+        >>> ctxt = prover.new_mac()
+        >>> for chunk in payload.chunks(5):
+        ...     ctxt.update(chunk)
+        >>> ctxt.finalize() == prover.gen_mac(payload)
+        True
+        """
+        return MacContext(hmac.new(self._secret_key, digestmod=hash_function))
+
+class MacContext:
+    """An HMAC computed over data that arrives in chunks."""
+
+    def __init__(self, hmac_ctxt):
+        self._hmac_ctxt = hmac_ctxt
+        self._auth = None
+
+    def update(self, chunk):
+        """Add chunk, which is bytes-like or an Encoding, to the
+        authenticated data.  An Encoding is read through its chunks()
+        so its buffer is never copied.
+
+        >>> prover = MessageAuthenticationCode("fake_secret_key".encode('utf-8'))
+        >>> header = codec.encode_one_int(2)
+        >>> body = codec.encode_one_bin(b"photo" * 100)
+        >>> ctxt = prover.new_mac()
+        >>> ctxt.update(header)
+        >>> ctxt.update(body)
+        >>> whole = codec.Encoding(header.bytes_data + body.bytes_data)
+        >>> ctxt.verify(prover.gen_mac(whole))
+        True
+        >>> ctxt.update(b"late")
+        Traceback (most recent call last):
+                ...
+        Exception: MAC already finalized
+        """
+        if self._auth != None:
+            raise Exception("MAC already finalized")
+        if type(chunk) is codec.Encoding:
+            for piece in chunk.chunks():
+                self._hmac_ctxt.update(piece)
+        else:
+            self._hmac_ctxt.update(chunk)
+
+    def finalize(self):
+        """Get the message authenticator.  No more data can be added."""
+        if self._auth == None:
+            self._auth = self._hmac_ctxt.digest()
+        return self._auth
+
+    def verify(self, auth):
+        """Check auth against the authenticator of the data so far."""
+        return hmac.compare_digest(self.finalize(), auth)
+
+# retention policies for _HashChain: keep every node, or only the tip
+KEEP_ALL_NODES = 1
+KEEP_TIP_ONLY = 0
+
 class _HashChain:
     """Create a hash chain given a list of hash outputs.
     >>> enc = codec.encode_one_int
@@ -148,54 +468,153 @@ class _HashChain:
     True
     >>> hchain0.hash() == hchain2.hash()
     True
+
+    keep_every sets how many intermediate nodes are retained: every
+    node (KEEP_ALL_NODES), every k-th node, or only the first node and
+    the tip (KEEP_TIP_ONLY).  node() recomputes a dropped node from the
+    nearest retained one.
+
+    >>> hchain3 = _HashChain(hlist0, keep_every=4)
+    >>> len(hchain3.nodes)
+    2
+    >>> [hchain3.node(i, hlist0) for i in range(7)] == hchain0.nodes
+    True
+    >>> hchain4 = _HashChain(hlist0, keep_every=KEEP_TIP_ONLY)
+    >>> len(hchain4.nodes), hchain4.hash() == hchain0.hash()
+    (1, True)
+    >>> hchain4.node(3, hlist0) == hchain0.nodes[3]
+    True
+
+    A chain is tagged with the name of its hash backend, which is the
+    deployment's backend unless algorithm is given.
+
+    >>> hlist5 = to_hlist([enc(9), enc(4)], algorithm="blake2b_256")
+    >>> hchain5 = _HashChain(hlist5, algorithm="blake2b_256")
+    >>> hchain5.algorithm, hchain5.hash() == _HashChain(hlist5).hash()
+    ('blake2b_256', False)
     """
-    def __init__(self, hlist, first_node=hash_function().digest()):
-        self.nodes = []
+    def __init__(self, hlist, first_node=None, keep_every=KEEP_ALL_NODES, algorithm=None):
+        self._hash = get_hash_backend(algorithm)
+        self.algorithm = hash_backend if algorithm == None else algorithm
+        if first_node == None:
+            first_node = self._hash().digest()
+        self._keep_every = keep_every
+        self._length = 0
+        self._tip = first_node
+        self.nodes = [] # the retained nodes, starting with first_node
         self.nodes.append(first_node)
         self.add_hashes(hlist)
 
     def add_hashes(self, hlist):
         """Add new hashes to the hash chain and compute the new corresponding item hashes.
         """
+        keep_every = self._keep_every
         for h in hlist:
-            h_ctxt = hash_function()
-            h_ctxt.update(self.nodes[-1])
+            h_ctxt = self._hash()
+            h_ctxt.update(self._tip)
             h_ctxt.update(h)
-            self.nodes.append(h_ctxt.digest())
+            self._tip = h_ctxt.digest()
+            self._length += 1
+            if keep_every and self._length % keep_every == 0:
+                self.nodes.append(self._tip)
         
     def hash(self):
-        return self.nodes[-1]
+        return self._tip
 
-def to_hlist(data):
-    """Convert a list of codec.Encoding to a list of hashes."""
-    hlist = []
+    def node(self, position, hlist):
+        """Get the node after the first position hashes of the chain.
+
+        hlist must hold every hash added to the chain since its first
+        node; only those after the nearest retained node are rehashed.
+        """
+        if position < 0 or position > self._length:
+            raise IndexError("hash chain position out of range")
+        if position == self._length:
+            return self._tip
+        if self._keep_every:
+            index = position // self._keep_every
+        else:
+            index = 0
+        node = self.nodes[index]
+        for h in hlist[index * self._keep_every:position]:
+            h_ctxt = self._hash()
+            h_ctxt.update(node)
+            h_ctxt.update(h)
+            node = h_ctxt.digest()
+        return node
+
+# hashlib releases the GIL while hashing large buffers, so big batches
+# of leaves are hashed on a thread pool once they pass these thresholds
+PARALLEL_HASH_MIN_ITEMS = 2
+PARALLEL_HASH_MIN_BYTES = 1 << 20
+_HASH_WORKERS = os.cpu_count() or 1
+_hash_pool = None
+
+def _hash_leaf(bytes_data, hash_ctor):
+    h_ctxt = hash_ctor()
+    h_ctxt.update(bytes_data)
+    return h_ctxt.digest()
+
+def _hash_leaves(bytes_list, hash_ctor):
+    return [_hash_leaf(d, hash_ctor) for d in bytes_list]
+
+def to_hlist(data, parallel=None, algorithm=None):
+    """Convert a list of codec.Encoding to a list of hashes, using the
+    backend named algorithm or the deployment's backend.
+
+    If parallel is None, leaves are hashed on a thread pool when the
+    batch is large enough; True or False forces either path.  The
+    hashes are returned in the order of data either way.
+
+    >>> data = [codec.encode_one_bin(bytes([i]) * 4096) for i in range(8)]
+    >>> to_hlist(data, parallel=True) == to_hlist(data, parallel=False)
+    True
+    """
+    global _hash_pool
+    hash_ctor = get_hash_backend(algorithm)
+    bytes_list = []
     for d in data:
         if type(d) is not codec.Encoding:
             raise TypeError("data must be Encoding")
-        d = d.bytes_data
-        h_ctxt = hash_function()
-        h_ctxt.update(d)
-        hlist.append(h_ctxt.digest())
+        bytes_list.append(d.bytes_data)
+    if parallel == None:
+        parallel = (_HASH_WORKERS > 1 and
+                    len(bytes_list) >= PARALLEL_HASH_MIN_ITEMS and
+                    sum(len(d) for d in bytes_list) >= PARALLEL_HASH_MIN_BYTES)
+    if not parallel:
+        return _hash_leaves(bytes_list, hash_ctor)
+    if _hash_pool is None:
+        _hash_pool = ThreadPoolExecutor(max_workers=_HASH_WORKERS)
+    # one contiguous slice per worker keeps the per-task overhead low
+    step = max(1, -(-len(bytes_list) // _HASH_WORKERS))
+    slices = [bytes_list[i:i + step] for i in range(0, len(bytes_list), step)]
+    hlist = []
+    for hashes in _hash_pool.map(lambda bytes_slice: _hash_leaves(bytes_slice, hash_ctor), slices):
+        hlist += hashes
     return hlist
 
-def _hash_list(hlist):
+def _hash_list(hlist, algorithm=None):
     """Get the hash of a list of hashes."""
-    hchain = _HashChain(hlist)
+    hchain = _HashChain(hlist, keep_every=KEEP_TIP_ONLY, algorithm=algorithm)
     return hchain.hash()
 
-def list_data_hash(data):
-    """Hash the given list of codec.Encoding data.
+def list_data_hash(data, algorithm=None):
+    """Hash the given list of codec.Encoding data, using the backend
+    named algorithm or the deployment's backend.  The hash is tagged
+    with its backend.
 
     >>> enc = codec.encode_one_int
     >>> list_data_hash([enc(9), enc(4), enc(4), enc(3), enc(2), enc(1)]).hex()
     'd2a3f67087d74f00eebf1ae49665f76c9dfe9f8031c8614bedb8b9f73f4fb4d4'
     """
-    hlist = to_hlist(data)
-    return _hash_list(hlist)
+    if algorithm == None:
+        algorithm = hash_backend
+    hlist = to_hlist(data, algorithm=algorithm)
+    return _tag_digest(_hash_list(hlist, algorithm), algorithm)
 
 def verify_list_data_hash(data, output):
     """Verify that the given list of codec.Encoding data corresponds
-    to the given hash output.
+    to the given hash output, using the backend output is tagged with.
 
     >>> enc = codec.encode_one_int
     >>> hex = 'd2a3f67087d74f00eebf1ae49665f76c9dfe9f8031c8614bedb8b9f73f4fb4d4'
@@ -203,9 +622,324 @@ def verify_list_data_hash(data, output):
     >>> verify_list_data_hash([enc(9), enc(4), enc(4), enc(3), enc(2), enc(1)], expect)
     True
     """
-    hlist = to_hlist(data)
-    hchain = _HashChain(hlist)
-    return hchain.hash() == output
+    tagged = _untag_digest(output)
+    if tagged == None:
+        return False
+    (algorithm, digest) = tagged
+    hlist = to_hlist(data, algorithm=algorithm)
+    return _hash_list(hlist, algorithm) == digest
+
+class ListDataHashAccumulator:
+    """Incrementally hash a growing list of codec.Encoding data.
+
+    The accumulator keeps only the tip of the hash chain and the number
+    of items hashed so far, so adding or verifying k new items costs
+    O(k).  Its state can be saved with checkpoint() and restored by
+    passing the checkpoint to the constructor.
+
+    >>> enc = codec.encode_one_int
+    >>> acc = ListDataHashAccumulator()
+    >>> acc.add([enc(9), enc(4), enc(4)])
+    >>> saved = acc.checkpoint()
+    >>> resumed = ListDataHashAccumulator(saved)
+    >>> resumed.length()
+    3
+    >>> expect = list_data_hash([enc(9), enc(4), enc(4), enc(3), enc(2), enc(1)])
+    >>> resumed.verify([enc(3), enc(2), enc(1)], expect)
+    True
+    >>> resumed.length()
+    3
+    >>> resumed.add([enc(3), enc(2), enc(1)])
+    >>> resumed.hash() == expect
+    True
+
+    The checkpoint is tagged with the hash backend, so a chain resumes
+    with the backend it was started with.  Checkpoints from before
+    chains were tagged have no tag and use LEGACY_HASH_BACKEND.
+
+    >>> acc = ListDataHashAccumulator(algorithm="blake2b_256")
+    >>> acc.add([enc(9)])
+    >>> set_hash_backend("sha256")
+    >>> ListDataHashAccumulator(acc.checkpoint()).algorithm
+    'blake2b_256'
+    >>> legacy = codec.Encoding()
+    >>> legacy.add_int(0)
+    >>> legacy.add_bin(hashlib.sha3_256().digest())
+    >>> ListDataHashAccumulator(legacy).algorithm
+    'sha3_256'
+    >>> set_hash_backend(LEGACY_HASH_BACKEND)
+    """
+    def __init__(self, checkpoint=None, algorithm=None):
+        if checkpoint == None:
+            self.algorithm = hash_backend if algorithm == None else algorithm
+            self._length = 0
+            self._tip = get_hash_backend(self.algorithm)().digest()
+        else:
+            items = list(checkpoint.items())
+            if len(items) == 2:
+                items.append(LEGACY_HASH_BACKEND)
+            if (len(items) != 3 or type(items[0]) is not int or type(items[1]) is not bytes
+                    or type(items[2]) is not str):
+                raise ValueError("malformed hash chain checkpoint")
+            (self._length, self._tip, self.algorithm) = items
+            if algorithm != None and algorithm != self.algorithm:
+                raise ValueError("checkpoint uses hash backend {!r}".format(self.algorithm))
+        get_hash_backend(self.algorithm)
+
+    def _extend(self, data):
+        hlist = to_hlist(data, algorithm=self.algorithm)
+        hchain = _HashChain(hlist, self._tip, KEEP_TIP_ONLY, self.algorithm)
+        return (self._length + len(hlist), hchain.hash())
+
+    def add(self, data):
+        """Add a list of codec.Encoding data to the hashed list."""
+        (self._length, self._tip) = self._extend(data)
+
+    def verify(self, data, output):
+        """Check that the hashed list followed by data hashes to output,
+        without adding data."""
+        return _tag_digest(self._extend(data)[1], self.algorithm) == output
+
+    def hash(self):
+        """Get the hash of the list, tagged like list_data_hash's."""
+        return _tag_digest(self._tip, self.algorithm)
+
+    def length(self):
+        return self._length
+
+    def checkpoint(self):
+        checkpoint = codec.Encoding()
+        checkpoint.add_int(self._length)
+        checkpoint.add_bin(self._tip)
+        checkpoint.add_string(self.algorithm)
+        return checkpoint
+
+class MerkleTree:
+    """A Merkle tree over a list of hash outputs, as an alternative to
+    _HashChain that supports O(log n) proofs.
+
+    Leaves are the hashes produced by to_hlist.  Hashing follows RFC
+    6962: a leaf is hashed with a 0x00 prefix and an interior node with
+    a 0x01 prefix.  Every complete subtree is retained, so appending a
+    leaf costs amortized O(1) hashes.
+
+    An inclusion proof shows that a leaf belongs to the tree, and a
+    consistency proof shows that an older version of the tree is a
+    prefix of a newer one.
+
+    >>> enc = codec.encode_one_int
+    >>> hlist = to_hlist([enc(i) for i in range(11)])
+    >>> tree = MerkleTree(hlist[:6])
+    >>> old_root = tree.root()
+    >>> tree.add_hashes(hlist[6:])
+    >>> proof = tree.inclusion_proof(4)
+    >>> len(proof)
+    4
+    >>> verify_inclusion(hlist[4], 4, tree.size(), proof, tree.root())
+    True
+    >>> verify_inclusion(hlist[5], 4, tree.size(), proof, tree.root())
+    False
+    >>> proof = tree.consistency_proof(6)
+    >>> verify_consistency(6, old_root, tree.size(), tree.root(), proof)
+    True
+    >>> tree.root(6) == old_root
+    True
+    >>> all(verify_inclusion(hlist[i], i, n, tree.inclusion_proof(i, n), tree.root(n))
+    ...     for n in range(1, 12) for i in range(n))
+    True
+    >>> all(verify_consistency(m, tree.root(m), n, tree.root(n), tree.consistency_proof(m, n))
+    ...     for n in range(1, 12) for m in range(0, n + 1))
+    True
+
+    Like a hash chain, a tree is tagged with its hash backend.  Its
+    roots carry the tag, and proofs are checked with the backend of the
+    root they are checked against.
+
+    >>> hlist = to_hlist([enc(i) for i in range(11)], algorithm="sha256")
+    >>> tree = MerkleTree(hlist, algorithm="sha256")
+    >>> verify_inclusion(hlist[4], 4, tree.size(), tree.inclusion_proof(4), tree.root())
+    True
+    >>> verify_consistency(6, tree.root(6), 11, tree.root(), tree.consistency_proof(6))
+    True
+    >>> verify_consistency(6, old_root, 11, tree.root(), tree.consistency_proof(6))
+    False
+    """
+    def __init__(self, hlist=[], algorithm=None):
+        self.algorithm = hash_backend if algorithm == None else algorithm
+        self._hash = get_hash_backend(self.algorithm)
+        self._levels = [[]] # _levels[j][i] is the root of leaves [i * 2**j, (i + 1) * 2**j)
+        self.add_hashes(hlist)
+
+    def add_hashes(self, hlist):
+        for h in hlist:
+            node = _merkle_leaf(h, self._hash)
+            level = 0
+            self._levels[0].append(node)
+            while len(self._levels[level]) % 2 == 0:
+                (left, right) = self._levels[level][-2:]
+                level += 1
+                if len(self._levels) == level:
+                    self._levels.append([])
+                self._levels[level].append(_merkle_node(left, right, self._hash))
+
+    def size(self):
+        return len(self._levels[0])
+
+    def _check_size(self, size):
+        if size == None:
+            return self.size()
+        if size < 0 or size > self.size():
+            raise IndexError("Merkle tree size out of range")
+        return size
+
+    def _subtree(self, lo, hi):
+        """Get the root of the subtree over leaves [lo, hi)."""
+        n = hi - lo
+        if n & (n - 1) == 0 and lo % n == 0:
+            level = n.bit_length() - 1
+            return self._levels[level][lo >> level]
+        k = 1 << ((n - 1).bit_length() - 1)
+        return _merkle_node(self._subtree(lo, lo + k), self._subtree(lo + k, hi), self._hash)
+
+    def root(self, size=None):
+        """Get the root of the tree, or of its version with size leaves,
+        tagged with the tree's backend."""
+        size = self._check_size(size)
+        if size == 0:
+            return _tag_digest(self._hash().digest(), self.algorithm)
+        return _tag_digest(self._subtree(0, size), self.algorithm)
+
+    def inclusion_proof(self, index, size=None):
+        """Prove that leaf index belongs to the version with size leaves."""
+        size = self._check_size(size)
+        if index < 0 or index >= size:
+            raise IndexError("Merkle tree leaf index out of range")
+        proof = []
+        lo = 0
+        hi = size
+        while hi - lo > 1:
+            k = 1 << ((hi - lo - 1).bit_length() - 1)
+            if index < lo + k:
+                proof.append(self._subtree(lo + k, hi))
+                hi = lo + k
+            else:
+                proof.append(self._subtree(lo, lo + k))
+                lo = lo + k
+        proof.reverse()
+        return proof
+
+    def consistency_proof(self, old_size, size=None):
+        """Prove that the version with old_size leaves is a prefix of the
+        version with size leaves."""
+        size = self._check_size(size)
+        if old_size < 0 or old_size > size:
+            raise IndexError("Merkle tree size out of range")
+        proof = []
+        if old_size == 0 or old_size == size:
+            return proof
+        m = old_size
+        lo = 0
+        hi = size
+        complete = True
+        while m != hi - lo:
+            k = 1 << ((hi - lo - 1).bit_length() - 1)
+            if m <= k:
+                proof.append(self._subtree(lo + k, hi))
+                hi = lo + k
+            else:
+                proof.append(self._subtree(lo, lo + k))
+                lo = lo + k
+                m -= k
+                complete = False
+        if not complete:
+            proof.append(self._subtree(lo, hi))
+        proof.reverse()
+        return proof
+
+def _merkle_leaf(h, hash_ctor):
+    h_ctxt = hash_ctor()
+    h_ctxt.update(b'\x00')
+    h_ctxt.update(h)
+    return h_ctxt.digest()
+
+def _merkle_node(left, right, hash_ctor):
+    h_ctxt = hash_ctor()
+    h_ctxt.update(b'\x01')
+    h_ctxt.update(left)
+    h_ctxt.update(right)
+    return h_ctxt.digest()
+
+def verify_inclusion(h, index, size, proof, root):
+    """Check a MerkleTree inclusion proof for the hash h at position
+    index in a tree with size leaves and the given root, using the
+    backend root is tagged with."""
+    tagged = _untag_digest(root)
+    if tagged == None:
+        return False
+    (algorithm, root) = tagged
+    hash_ctor = get_hash_backend(algorithm)
+    if index < 0 or index >= size:
+        return False
+    fn = index
+    sn = size - 1
+    r = _merkle_leaf(h, hash_ctor)
+    for p in proof:
+        if sn == 0:
+            return False
+        if fn & 1 or fn == sn:
+            r = _merkle_node(p, r, hash_ctor)
+            while not fn & 1 and fn != 0:
+                fn >>= 1
+                sn >>= 1
+        else:
+            r = _merkle_node(r, p, hash_ctor)
+        fn >>= 1
+        sn >>= 1
+    return sn == 0 and r == root
+
+def verify_consistency(old_size, old_root, size, root, proof):
+    """Check a MerkleTree consistency proof between the version with
+    old_size leaves and old_root and the one with size leaves and root.
+    Both roots must be tagged with the same backend, which is used to
+    check the proof."""
+    old_tagged = _untag_digest(old_root)
+    tagged = _untag_digest(root)
+    if old_tagged == None or tagged == None or old_tagged[0] != tagged[0]:
+        return False
+    (algorithm, root) = tagged
+    old_root = old_tagged[1]
+    hash_ctor = get_hash_backend(algorithm)
+    if old_size < 0 or old_size > size:
+        return False
+    if old_size == 0:
+        return old_root == hash_ctor().digest() and len(proof) == 0
+    if old_size == size:
+        return old_root == root and len(proof) == 0
+    if old_size & (old_size - 1) == 0:
+        proof = [old_root] + proof
+    if len(proof) == 0:
+        return False
+    fn = old_size - 1
+    sn = size - 1
+    while fn & 1:
+        fn >>= 1
+        sn >>= 1
+    fr = proof[0]
+    sr = proof[0]
+    for c in proof[1:]:
+        if sn == 0:
+            return False
+        if fn & 1 or fn == sn:
+            fr = _merkle_node(c, fr, hash_ctor)
+            sr = _merkle_node(c, sr, hash_ctor)
+            while not fn & 1 and fn != 0:
+                fn >>= 1
+                sn >>= 1
+        else:
+            sr = _merkle_node(sr, c, hash_ctor)
+        fn >>= 1
+        sn >>= 1
+    return fr == old_root and sr == root and sn == 0
 
 class PublicKeySignature:
     def __init__(self, secret_key=None):
@@ -257,14 +991,55 @@ def verify_sign(pk, data, signature):
     >>> verify_sign(pk, payload, signature)
     True
     """
-    verify_key = VerifyKey(pk)
-    bytes_data = data.bytes_data
+    return _verify_bytes(bytes(pk), data.bytes_data, signature)
+
+@functools.lru_cache(maxsize=1024)
+def _verify_key(pk):
+    return VerifyKey(pk)
+
+def _verify_bytes(pk, bytes_data, signature):
+    verify_key = _verify_key(pk)
     try:
         ret = (verify_key.verify(bytes_data, signature) == bytes_data)
     except nacl.exceptions.BadSignatureError:
         return False
     return ret
 
+def _verify_bytes_batch(items):
+    return [_verify_bytes(*item) for item in items]
+
+# batches at least this large are split across processes when requested
+PARALLEL_VERIFY_MIN_ITEMS = 1000
+
+def verify_sign_batch(items, processes=None):
+    """Check a list of (pk, data, signature) triples and return one
+    result per triple, in order.
+
+    VerifyKey objects are cached across calls, so checking many
+    signatures from the same users does not rebuild their keys.  If
+    processes is set and the batch has at least
+    PARALLEL_VERIFY_MIN_ITEMS triples, it is split across that many
+    processes.
+
+    >>> prover = PublicKeySignature()
+    >>> pk = prover.get_public_key()
+    >>> payloads = [codec.encode_one_int(i) for i in range(3)]
+    >>> items = [(pk, p, prover.sign(p)) for p in payloads]
+    >>> items[1] = (pk, payloads[1], prover.sign(payloads[2]))
+    >>> verify_sign_batch(items)
+    [True, False, True]
+    """
+    items = [(bytes(pk), data.bytes_data, signature) for (pk, data, signature) in items]
+    if processes == None or processes < 2 or len(items) < PARALLEL_VERIFY_MIN_ITEMS:
+        return _verify_bytes_batch(items)
+    step = -(-len(items) // processes)
+    chunks = [items[i:i + step] for i in range(0, len(items), step)]
+    results = []
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for chunk_results in pool.map(_verify_bytes_batch, chunks):
+            results += chunk_results
+    return results
+
 def generate_symmetric_secret_key():
     return random(SecretBox.KEY_SIZE)
 
@@ -295,8 +1070,199 @@ class SymmetricKeyEncryption:
     def decrypt(self, cypher_text):
         return self.box.decrypt(cypher_text)
 
+    def encrypt_stream(self, chunks, chunk_size=None):
+        """Encrypt an iterable of bytes-like chunks, or an Encoding,
+        yielding the encrypted stream piece by piece.
+
+        >>> prover = SymmetricKeyEncryption()
+        >>> photo = codec.encode_one_bin(b"photo" * 1000)
+        >>> stream = list(prover.encrypt_stream(photo, chunk_size=1024))
+        >>> b"".join(prover.decrypt_stream(stream)) == photo.bytes_data
+        True
+        """
+        if type(chunks) is codec.Encoding:
+            chunks = chunks.chunks()
+        encryptor = StreamEncryptor(self._sk, chunk_size)
+        yield encryptor.header
+        for chunk in chunks:
+            out = encryptor.push(chunk)
+            if len(out) > 0:
+                yield out
+        yield encryptor.finish()
+
+    def decrypt_stream(self, cypher_chunks, max_chunk_size=None):
+        """Decrypt the output of encrypt_stream, yielding the plaintext
+        piece by piece.  Raises CryptoError if the stream was tampered
+        with or cut short, but only once the bad record is reached."""
+        decryptor = StreamDecryptor(self._sk, max_chunk_size)
+        for chunk in cypher_chunks:
+            for plain in decryptor.feed(chunk):
+                yield plain
+        for plain in decryptor.close():
+            yield plain
+
+# plaintext bytes per record of an encrypted stream, and the largest
+# record size a decryptor accepts from a stream header
+STREAM_CHUNK_SIZE = 1 << 16
+STREAM_MAX_CHUNK_SIZE = 16 * STREAM_CHUNK_SIZE
+
+_STREAM_CHUNK_SIZE_BYTES = 4
+
+class StreamEncryptor:
+    def __init__(self, secret_key, chunk_size=None):
+        """Encrypt a stream of any length with bounded memory.
+
+        The stream is a header, the record size, then records of
+        chunk_size plaintext bytes each encrypted with
+        XChaCha20-Poly1305 secretstream.  Each record has its own nonce
+        derived from the stream state, and the last one is tagged
+        final, so records cannot be reordered, dropped or truncated
+        without detection.
+
+        >>> key = generate_symmetric_secret_key()
+        >>> encryptor = StreamEncryptor(key, chunk_size=4)
+        >>> out = encryptor.header + encryptor.push(b"hello ") + encryptor.push(b"world")
+        >>> out += encryptor.finish()
+        >>> decryptor = StreamDecryptor(key)
+        >>> plain = decryptor.feed(out[:30]) + decryptor.feed(out[30:])
+        >>> b"".join(plain + decryptor.close())
+        b'hello world'
+        """
+        if chunk_size == None:
+            chunk_size = STREAM_CHUNK_SIZE
+        if chunk_size <= 0 or chunk_size > STREAM_MAX_CHUNK_SIZE:
+            raise ValueError("chunk_size out of range")
+        self._chunk_size = chunk_size
+        self._size_bytes = chunk_size.to_bytes(_STREAM_CHUNK_SIZE_BYTES, 'little')
+        self._state = crypto_secretstream_xchacha20poly1305_state()
+        self.header = crypto_secretstream_xchacha20poly1305_init_push(self._state, secret_key) + self._size_bytes
+        self._pending = bytearray()
+        self._finished = False
+
+    def _push(self, chunk, tag):
+        # the record size is authenticated with every record
+        return crypto_secretstream_xchacha20poly1305_push(self._state, bytes(chunk), self._size_bytes, tag)
+
+    def push(self, data):
+        """Add plaintext and return the records it completed.
+
+        A full record is held back until more data arrives, since the
+        last record must carry the final tag."""
+        if self._finished:
+            raise Exception("Stream already finished")
+        self._pending += data
+        out = []
+        start = 0
+        while len(self._pending) - start > self._chunk_size:
+            out.append(self._push(self._pending[start:start + self._chunk_size], _STREAM_TAG_MESSAGE))
+            start += self._chunk_size
+        del self._pending[:start]
+        return b"".join(out)
+
+    def finish(self):
+        """Return the final record.  No more data can be pushed."""
+        if self._finished:
+            raise Exception("Stream already finished")
+        self._finished = True
+        out = self._push(self._pending, _STREAM_TAG_FINAL)
+        self._pending = None
+        return out
+
+class StreamDecryptor:
+    def __init__(self, secret_key, max_chunk_size=None):
+        """Decrypt a stream made by StreamEncryptor as it arrives.
+
+        Only the record currently being read is buffered.  The record
+        size comes from the unauthenticated header, so streams whose
+        records are larger than max_chunk_size (STREAM_MAX_CHUNK_SIZE
+        by default) are rejected before anything is buffered.  Every
+        failure raises nacl.exceptions.CryptoError, as
+        SymmetricKeyEncryption.decrypt does.
+
+        >>> key = generate_symmetric_secret_key()
+        >>> encryptor = StreamEncryptor(key, chunk_size=4)
+        >>> out = encryptor.header + encryptor.push(b"hello world") + encryptor.finish()
+        >>> decryptor = StreamDecryptor(key)
+        >>> plain = decryptor.feed(out[:-1])
+        >>> decryptor.close()
+        Traceback (most recent call last):
+                ...
+        nacl.exceptions.CryptoError: Encrypted stream record failed to decrypt
+        >>> decryptor = StreamDecryptor(key)
+        >>> plain = decryptor.feed(out[:-20])
+        >>> decryptor.close()
+        Traceback (most recent call last):
+                ...
+        nacl.exceptions.CryptoError: Encrypted stream truncated
+        >>> StreamDecryptor(key, max_chunk_size=2).feed(out)
+        Traceback (most recent call last):
+                ...
+        nacl.exceptions.CryptoError: Encrypted stream records of 4 bytes exceed the limit of 2
+        """
+        if max_chunk_size == None:
+            max_chunk_size = STREAM_MAX_CHUNK_SIZE
+        self._max_chunk_size = max_chunk_size
+        self._sk = secret_key
+        self._state = None
+        self._record_size = None
+        self._pending = bytearray()
+        self._finished = False
+
+    def _start(self):
+        header_size = _STREAM_HEADERBYTES + _STREAM_CHUNK_SIZE_BYTES
+        if len(self._pending) < header_size:
+            return False
+        self._state = crypto_secretstream_xchacha20poly1305_state()
+        crypto_secretstream_xchacha20poly1305_init_pull(self._state, bytes(self._pending[:_STREAM_HEADERBYTES]), self._sk)
+        self._size_bytes = bytes(self._pending[_STREAM_HEADERBYTES:header_size])
+        chunk_size = int.from_bytes(self._size_bytes, 'little')
+        if chunk_size > self._max_chunk_size:
+            raise CryptoError("Encrypted stream records of {} bytes exceed the limit of {}".format(
+                chunk_size, self._max_chunk_size))
+        self._record_size = chunk_size + _STREAM_ABYTES
+        del self._pending[:header_size]
+        return True
+
+    def _pull(self, record):
+        if self._finished:
+            raise CryptoError("Data after the end of the encrypted stream")
+        try:
+            (plain, tag) = crypto_secretstream_xchacha20poly1305_pull(self._state, bytes(record), self._size_bytes)
+        except (nacl.exceptions.RuntimeError, nacl.exceptions.ValueError):
+            raise CryptoError("Encrypted stream record failed to decrypt")
+        if tag == _STREAM_TAG_FINAL:
+            self._finished = True
+        elif tag != _STREAM_TAG_MESSAGE:
+            raise CryptoError("Unexpected tag in encrypted stream")
+        return plain
+
+    def feed(self, chunk):
+        """Add encrypted bytes and return the plaintext of every record
+        they completed."""
+        self._pending += chunk
+        if self._state == None and not self._start():
+            return []
+        out = []
+        start = 0
+        while len(self._pending) - start >= self._record_size:
+            out.append(self._pull(self._pending[start:start + self._record_size]))
+            start += self._record_size
+        del self._pending[:start]
+        return out
+
+    def close(self):
+        """Decrypt the last, short record and check the stream ended
+        with the final tag."""
+        out = []
+        if self._state != None and len(self._pending) > 0:
+            out.append(self._pull(self._pending))
+            self._pending = bytearray()
+        if not self._finished:
+            raise CryptoError("Encrypted stream truncated")
+        return out
+
 class PublicKeyEncryptionAndAuthentication:
-    def __init__(self, secret_key=None):
+    def __init__(self, secret_key=None, box_cache_size=128):
         """Save the secret encryption key.
         If none is provided, generate a new secret key.
 
@@ -310,26 +1276,69 @@ class PublicKeyEncryptionAndAuthentication:
         >>> plain = receiver.decrypt_and_verify(cyphertxt, s_pk)
         >>> plain.decode()
         b'hello'
+
+        The Box for each peer, which holds the X25519 shared key, is
+        kept in an LRU cache of at most box_cache_size peers.
+
+        >>> sender = PublicKeyEncryptionAndAuthentication(box_cache_size=1)
+        >>> cyphertxt = sender.encrypt_and_auth(data, r_pk)
+        >>> sender.cached_peers() == [r_pk]
+        True
+        >>> cyphertxt = sender.encrypt_and_auth(data, s_pk)
+        >>> sender.cached_peers() == [s_pk]
+        True
+        >>> sender.evict_peer(s_pk)
+        >>> sender.cached_peers()
+        []
         """
         if secret_key == None:
             self._sk = PrivateKey.generate()
         else:
             self._sk = secret_key
+        self._box_cache_size = box_cache_size
+        self._boxes = OrderedDict()
+        self._boxes_lock = threading.Lock()
         
     def get_public_key(self):
         return self._sk.public_key
 
+    def _box(self, friend_pk):
+        # the cache may be shared between threads, e.g. by a web server
+        with self._boxes_lock:
+            box = self._boxes.get(friend_pk)
+            if box is not None:
+                self._boxes.move_to_end(friend_pk)
+                return box
+        # derive the shared key outside the lock so other peers are not held up
+        box = Box(self._sk, PublicKey(friend_pk))
+        if self._box_cache_size > 0:
+            with self._boxes_lock:
+                self._boxes[friend_pk] = box
+                while len(self._boxes) > self._box_cache_size:
+                    self._boxes.popitem(last=False)
+        return box
+
+    def cached_peers(self):
+        """List the peer public keys with a cached Box, least recently used first."""
+        with self._boxes_lock:
+            return list(self._boxes.keys())
+
+    def evict_peer(self, friend_pk=None):
+        """Drop the cached Box for friend_pk, or every cached Box if
+        friend_pk is None."""
+        with self._boxes_lock:
+            if friend_pk == None:
+                self._boxes.clear()
+            else:
+                self._boxes.pop(friend_pk, None)
+
     def encrypt_and_auth(self, data, friend_pk):
         if type(data) is not codec.Encoding:
             raise TypeError("data must be Encoding")
-        friend_pk = PublicKey(friend_pk)
-        box = Box(self._sk, friend_pk)
-        return box.encrypt(data.bytes_data)
+        return self._box(friend_pk).encrypt(data.bytes_data)
 
     def decrypt_and_verify(self, cypher_text, friend_pk):
-        friend_pk = PublicKey(friend_pk)
-        box = Box(self._sk, friend_pk)
-        return codec.Encoding(box.decrypt(cypher_text))
+        return codec.Encoding(self._box(friend_pk).decrypt(cypher_text))
 
 if __name__ == "__main__":
     import doctest
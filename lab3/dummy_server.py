@@ -87,6 +87,18 @@ class DummyServer:
         else:
             return api.GetPhotoResponse(api.Errcode.PHOTO_DOES_NOT_EXIST, None)
     
+    def get_photos_user(self, request):
+        if not self._storage.check_token(request.username, request.token):
+            return api.GetPhotosResponse(api.Errcode.INVALID_TOKEN, None)
+
+        photo_blobs = []
+        for photo_id in request.photo_ids:
+            photo = self._storage.load_photo(request.username, photo_id)
+            if photo == None:
+                return api.GetPhotosResponse(api.Errcode.PHOTO_DOES_NOT_EXIST, photo_blobs)
+            photo_blobs.append(photo.photo_blob)
+        return api.GetPhotosResponse(None, photo_blobs)
+
     def synchronize(self, request):
         if not self._storage.check_token(request.username, request.token):
             return api.SynchronizeResponse(api.Errcode.INVALID_TOKEN, None)
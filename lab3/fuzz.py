@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+"""
+fuzz checks codec round trips on randomly generated objects.
+
+Run `./fuzz.py [iterations] [seed]`.  Each iteration encodes a random
+add_obj input in both codec formats and checks that every decoder
+returns the expected items.
+"""
+
+import random
+import sys
+
+import codec
+
+def random_key(rng):
+    kind = rng.randrange(3)
+    if kind == 0:
+        return rng.choice([0, 1, 2**64 - 1, rng.randrange(2**64)])
+    elif kind == 1:
+        return rng.randbytes(rng.randrange(16))
+    else:
+        return "".join(rng.choice("aé€𝄞") for _ in range(rng.randrange(8)))
+
+def random_value(rng):
+    if rng.randrange(8) == 0:
+        return rng.randbytes(rng.randrange(4096))
+    return random_key(rng)
+
+def random_obj(rng, depth=0):
+    kind = rng.randrange(6 if depth < 3 else 5)
+    if kind == 0:
+        return None
+    elif kind == 1:
+        return {random_key(rng): random_value(rng) for _ in range(rng.randrange(6))}
+    elif kind < 5:
+        return random_value(rng)
+    else:
+        return [random_obj(rng, depth + 1) for _ in range(rng.randrange(6))]
+
+def expected_items(obj):
+    """add_obj flattens lists and drops None, so items() yields the leaves."""
+    if obj is None:
+        return []
+    elif type(obj) is list:
+        return [item for o in obj for item in expected_items(o)]
+    return [obj]
+
+def check(ok, what, *context):
+    """Fail loudly on a mismatch; unlike assert, this still runs under -O."""
+    if not ok:
+        raise Exception("{} mismatch: {!r}".format(what, context))
+
+def check_round_trip(rng, obj):
+    expect = expected_items(obj)
+    for compact in [False, True]:
+        enc = codec.Encoding(compact=compact)
+        enc.add_obj(obj)
+        data = enc.bytes_data
+        check(list(enc.items()) == expect, "items", compact, obj)
+
+        zero_copy = [item for _, item in enc.items_with_offsets(zero_copy=True)]
+        check([bytes(i) if type(i) is memoryview else i for i in zero_copy] == expect,
+              "zero-copy items", compact, obj)
+
+        decoder = codec.IncrementalDecoder()
+        items = []
+        i = 0
+        while i < len(data):
+            size = rng.randrange(1, 64)
+            items += decoder.feed(data[i:i + size])
+            i += size
+        decoder.close()
+        check(items == expect, "incremental items", compact, obj)
+
+        for d in [item for item in expect if type(item) is dict]:
+            sorted_enc = codec.Encoding(compact=compact)
+            sorted_enc.add_sorted_dict(d)
+            check(sorted_enc.decode() == d, "sorted dict", compact, d)
+            decoder = codec.Decoder(sorted_enc.bytes_data)
+            for (k, v) in d.items():
+                check(decoder.lookup(k) == v, "lookup", compact, d, k)
+
+def main(iterations, seed):
+    rng = random.Random(seed)
+    for _ in range(iterations):
+        check_round_trip(rng, random_obj(rng))
+    print("{} round trips passed (seed {})".format(iterations, seed))
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    main(iterations, seed)
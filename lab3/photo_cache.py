@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+photo_cache holds photo blobs for a client within a fixed memory budget.
+"""
+
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+class PhotoCache:
+    def __init__(self, memory_bytes=64 << 20, spill_dir=None):
+        """A content-addressed photo store in two tiers.
+
+        Blobs are kept in memory, least recently used first, up to
+        memory_bytes in total.  Blobs evicted from memory are written
+        to spill_dir, one file per blob named by its SHA-256 digest, and
+        read back on the next access.  If spill_dir is None, a temporary
+        directory is created on the first spill and removed with the
+        cache.
+
+        add() returns the key to get() the blob back with.
+
+        >>> cache = PhotoCache(memory_bytes=10)
+        >>> a = cache.add(b"AAAAAA")
+        >>> b = cache.add(b"BBBBBB")
+        >>> cache.memory_bytes, cache.spills
+        (6, 1)
+        >>> cache.get(b)
+        b'BBBBBB'
+        >>> cache.get(a)
+        b'AAAAAA'
+        >>> cache.hits, cache.misses
+        (1, 1)
+        >>> cache.add(b"AAAAAA") == a
+        True
+        >>> cache.get(b"missing")
+        Traceback (most recent call last):
+                ...
+        KeyError: b'missing'
+
+        Blobs read back from disk are checked against their name.
+
+        >>> with open(cache._path(b), "wb") as f:
+        ...     _ = f.write(b"CCCCCC")
+        >>> cache.get(b)
+        Traceback (most recent call last):
+                ...
+        Exception: Spilled photo 9d9816fe... does not match its digest
+        """
+        self.max_memory_bytes = memory_bytes
+        self.memory_bytes = 0
+        self.hits = 0   # gets served from memory
+        self.misses = 0 # gets read back from disk
+        self.spills = 0 # blobs written to disk
+        self._memory = OrderedDict() # key -> blob, least recently used first
+        self._on_disk = set()
+        self._spill_dir = spill_dir
+        self._tmpdir = None
+
+    def _path(self, key):
+        if self._spill_dir == None:
+            if self._tmpdir == None:
+                self._tmpdir = tempfile.TemporaryDirectory(prefix="photo_cache")
+            self._spill_dir = self._tmpdir.name
+        return os.path.join(self._spill_dir, key.hex())
+
+    def _remember(self, key, blob):
+        self._memory[key] = blob
+        self.memory_bytes += len(blob)
+        while self.memory_bytes > self.max_memory_bytes:
+            (old_key, old_blob) = self._memory.popitem(last=False)
+            self.memory_bytes -= len(old_blob)
+            self._spill(old_key, old_blob)
+
+    def _spill(self, key, blob):
+        if key in self._on_disk:
+            return
+        path = self._path(key)
+        if not os.path.exists(path):
+            # write then rename, so a reader never sees a partial blob
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(blob)
+            os.replace(tmp_path, path)
+        self._on_disk.add(key)
+        self.spills += 1
+
+    def add(self, blob):
+        """Store a blob and return its key."""
+        key = hashlib.sha256(blob).digest()
+        if key in self._memory:
+            self._memory.move_to_end(key)
+        elif key not in self._on_disk:
+            self._remember(key, bytes(blob))
+        return key
+
+    def get(self, key):
+        """Get the blob stored under key."""
+        if key in self._memory:
+            self.hits += 1
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        if key not in self._on_disk:
+            raise KeyError(key)
+        self.misses += 1
+        with open(self._path(key), "rb") as f:
+            blob = f.read()
+        if hashlib.sha256(blob).digest() != key:
+            raise Exception("Spilled photo {}... does not match its digest".format(key.hex()[:8]))
+        self._remember(key, blob)
+        return blob
+
+if __name__ == "__main__":
+    import doctest
+    exit(doctest.testmod()[0])
@@ -10,7 +10,7 @@ def system(cmd):
     os.system(cmd)
 
 # TODO put these in one place somewhere
-targets = ['app.py', 'api.py', 'client.py', 'codec.py', 'crypto.py', 'dummy_server.py', 'errors.py', 'util.py', 'wordlist.py', 'static']
+targets = ['app.py', 'api.py', 'client.py', 'codec.py', 'crypto.py', 'dummy_server.py', 'errors.py', 'photo_cache.py', 'util.py', 'wordlist.py', 'static']
 
 print("================================================================")
 with tempfile.TemporaryDirectory() as tmpdir: